@@ -0,0 +1,486 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+
+import recommendations
+from circuit_breaker import CircuitOpenError, check_operations
+from metrics import record_recommendation, record_stage_output, tier_span
+from pipeline import build_pipelines
+from rate_limiter import PRIMARY, SPECULATIVE, call_priority
+from recommendation_cache import pool_cache_key, sample_pool
+from recommendations import (
+    GENRE_SEEDS_CACHE_KEY, GENRE_SEEDS_ERROR_TTL, HEDGE_DEADLINE, MOOD_FEATURES, PIPELINE_SETTINGS,
+    RECOMMENDATION_FANOUT, RECOMMENDATION_MODE, RECOMMENDATION_POOL_SIZE, TARGET_TRACKS,
+    VALID_SPOTIFY_GENRES, SpotifyAuthError, _log_tier_failure, _sample_for_user, advanced_parameters,
+    available_genres, backup_tracks, candidate_target, finish_advanced, genre_seed_cache, is_auth_error,
+    plan_advanced_attempts, recently_seen, recommendation_pool_cache, remember_seen, rerank_failed,
+    rerank_plan, tier_priorities, user_tracks_cache, user_tracks_stage
+)
+from mood_ranking import rank_tracks, remember_features
+from tracks import TrackCollector, has_valid_album_art
+
+logger = logging.getLogger('moosic.async_recommendations')
+attempt_logger = logging.getLogger('moosic.recommendations.attempts')
+
+# The recommendation tiers from recommendations.py, as coroutines for
+# AsyncSpotify clients. They run on the async engine's event loop, so
+# concurrent upstream calls need no extra threads.
+
+_genre_refresh = None
+_genre_load = None  # Task loading the genre seeds while none are cached
+
+
+async def _cache_call(cache, method, *args, **kwargs):
+    """Call a TTLCache method, off the event loop when the cache has a file or database backend"""
+    if cache.backend is None:
+        return method(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(method, *args, **kwargs))
+
+
+async def _load_genre_seeds(sp):
+    available_genres = await sp.recommendation_genre_seeds()
+    genres = frozenset(available_genres.get('genres', []))
+    logger.debug("Loaded %s Spotify genre seeds", len(genres))
+    return await _cache_call(genre_seed_cache, genre_seed_cache.set, GENRE_SEEDS_CACHE_KEY, genres)
+
+
+async def _first_genre_seeds(sp):
+    try:
+        return await _load_genre_seeds(sp)
+    except Exception as genre_err:
+        if is_auth_error(genre_err):
+            raise
+        logger.warning("Failed to get genre seeds: %s", genre_err)
+        # Fall back to our own list for a while instead of retrying on every request
+        return await _cache_call(
+            genre_seed_cache, genre_seed_cache.set, GENRE_SEEDS_CACHE_KEY, VALID_SPOTIFY_GENRES,
+            ttl=GENRE_SEEDS_ERROR_TTL, stale_ttl=0
+        )
+
+
+async def _refresh_genre_seeds(sp):
+    try:
+        await _load_genre_seeds(sp)
+    except Exception as e:
+        # Keep serving the stale list until the next attempt
+        logger.warning("Background refresh of genre seeds failed: %s", e)
+
+
+async def get_genre_seeds(sp):
+    """Async get_genre_seeds(): same shared cache, refreshed on the event loop"""
+    global _genre_refresh, _genre_load
+    cached = await _cache_call(genre_seed_cache, genre_seed_cache.peek, GENRE_SEEDS_CACHE_KEY)
+    if cached is not None:
+        genres, fresh = cached
+        if not fresh and (_genre_refresh is None or _genre_refresh.done()):
+            _genre_refresh = asyncio.ensure_future(_refresh_genre_seeds(sp))
+        return genres
+
+    # Requests that find nothing cached wait for one load; shielded so a
+    # request that gives up doesn't cancel it for the others
+    if _genre_load is None or _genre_load.done():
+        _genre_load = asyncio.ensure_future(_first_genre_seeds(sp))
+        _genre_load.add_done_callback(_retrieve)
+    return await asyncio.shield(_genre_load)
+
+
+def _retrieve(task):
+    if not task.cancelled():
+        task.exception()  # Mark failures nobody waited for as handled
+
+
+def _detach(tasks):
+    """Stop waiting for tasks; like the sync engine, calls already sent run to completion"""
+    for task in tasks:
+        if task.done():
+            _retrieve(task)
+        else:
+            task.add_done_callback(_retrieve)
+
+
+async def _fetch_attempts(ctx, plans, stage):
+    """Yield (attempt, response or exception) in attempt order, RECOMMENDATION_FANOUT at a time.
+
+    Stops early when the stage's budget runs out while waiting for an attempt.
+    """
+    semaphore = asyncio.Semaphore(max(1, RECOMMENDATION_FANOUT))
+    started = set()
+
+    async def attempt(index):
+        genres, features = plans[index]
+        async with semaphore:
+            ctx.check_cancelled()
+            started.add(index)
+            attempt_logger.debug("Attempt %s: Calling Spotify recommendations API with genres=%s, features=%s", index + 1, genres, features)
+            return await ctx.sp.recommendations(
+                seed_genres=genres,
+                limit=stage.fetch_limit,  # Request more than we need to filter
+                **features
+            )
+
+    tasks = [asyncio.ensure_future(attempt(index)) for index in range(len(plans))]
+    try:
+        for index, task in enumerate(tasks):
+            done, _ = await asyncio.wait({task}, timeout=stage.remaining())
+            if not done:
+                logger.debug("Stopping after %s attempts: the %ss budget ran out", index, stage.budget)
+                return
+            try:
+                result = task.result()
+            except Exception as e:
+                result = e
+            yield index + 1, result
+    finally:
+        # Attempts still waiting for a slot are no longer needed
+        for index, task in enumerate(tasks):
+            if index not in started:
+                task.cancel()
+        _detach(tasks)
+
+
+async def rerank(ctx, tracks, stage):
+    """Async recommendations.rerank(): the audio-feature batches are fetched concurrently"""
+    stage.gathered = len(tracks)
+    plan = rerank_plan(ctx, tracks)
+    if plan is None:
+        return tracks[:TARGET_TRACKS]
+    mood_features, found, batches = plan
+    if stage.over_budget():
+        logger.debug("Re-ranking with cached audio features only: the %ss budget ran out", stage.budget)
+        batches = []
+    responses = await asyncio.gather(*(ctx.sp.audio_features(batch) for batch in batches), return_exceptions=True)
+    for batch, response in zip(batches, responses):
+        if isinstance(response, Exception):
+            rerank_failed(response)
+        else:
+            remember_features(batch, response, found)
+    return rank_tracks(tracks, found, mood_features, TARGET_TRACKS)
+
+
+# Method 0: Match the mood's audio features against the local catalog
+async def local_catalog_recommendations(ctx, stage):
+    # No network involved, but the first query per mood is CPU work, so keep it off the loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, recommendations.local_catalog_recommendations, ctx, stage)
+
+
+# Method 1: Try advanced recommendations with audio features based on mood
+async def advanced_recommendations(ctx, stage):
+    logger.debug("Trying advanced recommendations for mood: %s", ctx.mood_category)
+    audio_features, valid_genres = advanced_parameters(ctx.mood_category, ctx.genre)
+    valid_genres = available_genres(valid_genres, await get_genre_seeds(ctx.sp))
+
+    cache_key = None
+    if recommendation_pool_cache.enabled:
+        cache_key = pool_cache_key(ctx.mood_category, audio_features, valid_genres)
+        pool = recommendation_pool_cache.get(cache_key)
+        if pool is not None:
+            logger.debug("Sampling advanced recommendations from a cached pool of %s tracks", len(pool))
+            return _sample_for_user(ctx, pool)
+
+    ctx.check_cancelled()
+    check_operations(stage.operations)
+    collector = TrackCollector(stage.target if cache_key is None else RECOMMENDATION_POOL_SIZE)
+    errors = []
+    attempts = _fetch_attempts(ctx, plan_advanced_attempts(audio_features, valid_genres, stage.attempts), stage)
+    try:
+        async for attempt_count, current_recs in attempts:
+            if isinstance(current_recs, CircuitOpenError):
+                # The other attempts would be turned away by the same open circuit
+                errors.append(current_recs)
+                break
+            if isinstance(current_recs, Exception):
+                logger.warning("Attempt %s: Recommendations call failed: %s", attempt_count, current_recs)
+                errors.append(current_recs)
+                continue
+
+            if current_recs and 'tracks' in current_recs and current_recs['tracks']:
+                added = collector.extend(current_recs['tracks'])
+                attempt_logger.debug("Attempt %s: Found %s valid tracks", attempt_count, added)
+                ctx.publish(collector.tracks)
+
+            if collector.full:
+                break
+    finally:
+        await attempts.aclose()
+
+    return finish_advanced(ctx, collector, errors, cache_key, stage)
+
+
+async def fetch_user_tracks(sp, stage, limit, ctx=None):
+    """Async recommendations.fetch_user_tracks()"""
+    check_operations(stage.operations)
+    top_tracks = await sp.current_user_top_tracks(limit=stage.top_tracks, time_range='medium_term')
+
+    if not (top_tracks and 'items' in top_tracks and top_tracks['items']):
+        logger.warning("No user top tracks found")
+        raise Exception("No top tracks found")
+
+    top_track_ids = [track['id'] for track in top_tracks['items'] if track.get('id')]
+    track_ids = top_track_ids[:stage.seeds]
+    if not track_ids:
+        raise Exception("No valid track IDs found in user's top tracks")
+
+    collector = TrackCollector(limit)
+    for seed_id in track_ids:
+        if ctx is not None:
+            ctx.check_cancelled()
+        if stage.over_budget():
+            break
+        top_based_recommendations = await sp.recommendations(seed_tracks=[seed_id], limit=stage.fetch_limit)
+        if top_based_recommendations and 'tracks' in top_based_recommendations:
+            collector.extend(top_based_recommendations['tracks'])
+        if collector.full:
+            break
+    return {'top_tracks': top_track_ids, 'candidates': collector.tracks}
+
+
+# User key -> task refreshing that user's stale user_tracks_cache entry
+_user_tracks_refreshes = {}
+
+
+async def _refresh_user_tracks(sp, user_key):
+    try:
+        stage = user_tracks_stage()
+        with call_priority(SPECULATIVE):
+            user_tracks = await fetch_user_tracks(sp, stage, stage.cached_candidates)
+        if user_tracks['candidates']:
+            await asyncio.get_running_loop().run_in_executor(None, user_tracks_cache.set, user_key, user_tracks)
+    except Exception as e:
+        # Keep serving the stale entry until the next attempt
+        logger.warning("Background refresh of the user's top tracks failed: %s", e)
+    finally:
+        _user_tracks_refreshes.pop(user_key, None)
+
+
+async def cached_user_tracks(ctx, stage):
+    """Async recommendations.cached_user_tracks(); the cache's disk store is used off the loop"""
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, user_tracks_cache.peek, ctx.user_key)
+    if cached is None:
+        user_tracks = await fetch_user_tracks(ctx.sp, stage, stage.cached_candidates, ctx)
+        if user_tracks['candidates']:
+            await loop.run_in_executor(None, user_tracks_cache.set, ctx.user_key, user_tracks)
+        return user_tracks
+    user_tracks, fresh = cached
+    if not fresh and ctx.user_key not in _user_tracks_refreshes:
+        _user_tracks_refreshes[ctx.user_key] = asyncio.ensure_future(_refresh_user_tracks(ctx.sp, ctx.user_key))
+    return user_tracks
+
+
+# Method 2: Try with user's top tracks for diversity
+async def user_top_tracks_recommendations(ctx, stage):
+    logger.debug("Trying to get recommendations based on user's top tracks")
+    target = candidate_target(stage.target)
+    if user_tracks_cache is None or ctx.user_key is None:
+        candidates = (await fetch_user_tracks(ctx.sp, stage, target, ctx))['candidates']
+    else:
+        pool = (await cached_user_tracks(ctx, stage))['candidates']
+        candidates = sample_pool(pool, min(target, len(pool)), recently_seen.get(ctx.user_key))
+
+    if candidates:
+        logger.debug("Successfully got %s recommendations based on user's top tracks", len(candidates))
+        return await rerank(ctx, candidates, stage)
+    raise stage.no_tracks("No valid tracks after filtering user top tracks recommendations")
+
+
+# Method 3: Try simpler genre-based recommendations
+async def simple_genre_recommendations(ctx, stage):
+    sp = ctx.sp
+    logger.debug("Trying simple genre-based recommendations")
+    check_operations(stage.operations)
+
+    popular_genres = ["pop", "rock", "hip-hop", "dance", "electronic", "indie", "r-n-b", "jazz", "classical"]
+    random.shuffle(popular_genres)
+
+    collector = TrackCollector(candidate_target(stage.target))
+    per_call = stage.genres_per_call
+    for i in range(stage.calls):  # Try a few different genre combinations
+        ctx.check_cancelled()
+        selected_genres = popular_genres[i*per_call:(i+1)*per_call]
+        if not selected_genres or stage.over_budget():
+            break
+        logger.debug("Using popular genres '%s' for simple recommendations", selected_genres)
+        simple_recommendations = await sp.recommendations(seed_genres=selected_genres, limit=stage.fetch_limit)
+        if simple_recommendations and 'tracks' in simple_recommendations:
+            collector.extend(simple_recommendations['tracks'])
+        if collector.full:
+            break
+
+    if collector.tracks:
+        logger.debug("Got %s simple recommendations", len(collector))
+        return await rerank(ctx, collector.tracks, stage)
+    raise stage.no_tracks("No valid tracks after filtering")
+
+
+# Method 4: Try with featured playlists as a more reliable option
+async def featured_playlist_tracks(ctx, stage):
+    sp = ctx.sp
+    logger.debug("Trying to get tracks from featured playlists")
+    check_operations(stage.operations)
+    playlists = await sp.featured_playlists(limit=stage.playlists_listed)
+
+    if not (playlists and 'playlists' in playlists and playlists['playlists']['items']):
+        raise Exception("No featured playlists found")
+
+    collector = TrackCollector(candidate_target(stage.target))
+    for playlist_item in playlists['playlists']['items'][:stage.playlists]:
+        ctx.check_cancelled()
+        if stage.over_budget():
+            break
+        playlist_id = playlist_item.get('id')
+        try:
+            tracks_response = await sp.playlist_tracks(playlist_id, limit=stage.tracks_per_playlist)
+            if tracks_response and 'items' in tracks_response:
+                added = collector.extend(item.get('track') for item in tracks_response['items'])
+                attempt_logger.debug("Found %s valid tracks in playlist %s", added, playlist_item.get('name'))
+                if collector.full:
+                    break
+        except Exception as playlist_err:
+            logger.warning("Error processing playlist %s: %s", playlist_id, playlist_err)
+
+    if collector.tracks:
+        # Randomize the order for variety
+        all_tracks = collector.tracks
+        random.shuffle(all_tracks)
+        tracks = await rerank(ctx, all_tracks, stage)
+        logger.debug("Successfully got %s tracks from featured playlists", len(tracks))
+        return tracks
+    raise stage.no_tracks("No valid tracks found in any featured playlists")
+
+
+# Method 5: Try with new releases
+async def new_release_tracks(ctx, stage):
+    sp = ctx.sp
+    logger.debug("Trying to get tracks from new releases")
+    check_operations(stage.operations)
+    new_releases = await sp.new_releases(limit=stage.albums_listed)
+    if not (new_releases and 'albums' in new_releases and new_releases['albums']['items']):
+        raise Exception("No new releases found")
+
+    collector = TrackCollector(candidate_target(stage.target))
+    for album in new_releases['albums']['items'][:stage.albums]:
+        ctx.check_cancelled()
+        if stage.over_budget():
+            break
+        if not has_valid_album_art(album):
+            continue
+        try:
+            album_tracks = await sp.album_tracks(album['id'], limit=stage.tracks_per_album)
+            if album_tracks and 'items' in album_tracks:
+                for track in album_tracks['items'][:stage.tracks_kept_per_album]:
+                    track_with_album = track.copy()
+                    if 'album' not in track_with_album:
+                        track_with_album['album'] = album
+                    collector.add(track_with_album)
+                if collector.full:
+                    break
+        except Exception as album_err:
+            logger.warning("Error getting album tracks: %s", album_err)
+
+    if collector.tracks:
+        # Randomize the track order for variety
+        all_tracks = collector.tracks
+        random.shuffle(all_tracks)
+        tracks = await rerank(ctx, all_tracks, stage)
+        logger.debug("Successfully got %s tracks from new releases", len(tracks))
+        return tracks
+    raise stage.no_tracks("No tracks found in new releases")
+
+
+# The coroutine for each of recommendations.STAGES
+STAGE_COROUTINES = {
+    "local_catalog": local_catalog_recommendations,
+    "spotify_advanced": advanced_recommendations,
+    "spotify_user_top_tracks": user_top_tracks_recommendations,
+    "spotify_simple": simple_genre_recommendations,
+    "spotify_featured_playlist": featured_playlist_tracks,
+    "spotify_new_releases": new_release_tracks,
+}
+
+# Same stages, settings and per-mood order as the sync engine
+STAGES = [stage.bound(STAGE_COROUTINES[stage.source]) for stage in recommendations.STAGES]
+PIPELINES = build_pipelines(STAGES, MOOD_FEATURES, PIPELINE_SETTINGS)
+
+
+def pipeline_for(mood_category):
+    return PIPELINES.get(mood_category, PIPELINES[None])
+
+
+async def run_tier(stage, ctx, priority=PRIMARY):
+    """Run one tier within its budget, recording how long it took, how it ended and what it produced"""
+    run = stage.start()
+    # Tasks the tier starts inherit the priority along with the rest of its context
+    with tier_span(stage.source, ctx.mood_category), call_priority(priority):
+        tracks = await stage.run(ctx, run)
+    record_stage_output(stage.source, max(run.gathered, len(tracks)), len(tracks))
+    return tracks
+
+
+async def run_tiers_sequential(ctx):
+    """Try each tier in order until one returns tracks"""
+    for stage in pipeline_for(ctx.mood_category):
+        try:
+            return await run_tier(stage, ctx), stage.source
+        except Exception as e:
+            if is_auth_error(e):
+                raise SpotifyAuthError(str(e)) from e
+            _log_tier_failure(stage.name, stage.source, ctx.mood_category, e)
+    return backup_tracks(ctx.mood_category)
+
+
+async def run_tiers_hedged(ctx, deadline=None):
+    """Run every tier as a task and keep the highest-priority success (see recommendations.run_tiers_hedged)"""
+    deadline_at = time.monotonic() + (HEDGE_DEADLINE if deadline is None else deadline)
+    tier_ctx = ctx.quiet()
+    stages = pipeline_for(ctx.mood_category)
+    priorities = tier_priorities(stages)
+    tasks = [
+        (stage.source, stage.name, asyncio.ensure_future(run_tier(stage, tier_ctx, priorities[stage.source])))
+        for stage in stages
+    ]
+    try:
+        for source, name, task in tasks:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), remaining), source
+            except asyncio.TimeoutError:
+                logger.warning("Recommendation deadline reached while waiting for %s", name)
+                break
+            except Exception as e:
+                if is_auth_error(e):
+                    raise SpotifyAuthError(str(e)) from e
+                _log_tier_failure(name, source, ctx.mood_category, e)
+
+        # Out of time: use the best tier that has already finished
+        for source, name, task in tasks:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                return task.result(), source
+    finally:
+        # Tiers still running stop at their next check, as in the sync engine
+        ctx.cancelled.set()
+        _detach(task for _, _, task in tasks)
+    return backup_tracks(ctx.mood_category)
+
+
+async def get_recommendations(ctx, mode=None):
+    """Async recommendations.get_recommendations(): (tracks, source) using the configured mode"""
+    mode = mode or RECOMMENDATION_MODE
+    started = time.perf_counter()
+    if mode == 'hedged':
+        tracks, source = await run_tiers_hedged(ctx)
+    else:
+        tracks, source = await run_tiers_sequential(ctx)
+    record_recommendation(source, ctx.mood_category, started)
+    remember_seen(ctx, tracks, source)
+    ctx.publish(tracks)
+    return tracks, source
+
+
+async def get_recommendations_many(contexts, mode=None):
+    """Async recommendations.get_recommendations_many(): one result or exception per context"""
+    return await asyncio.gather(*(get_recommendations(ctx, mode) for ctx in contexts), return_exceptions=True)
@@ -0,0 +1,191 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+
+import aiohttp
+from spotipy.exceptions import SpotifyException
+
+from circuit_breaker import guarded, operation_for
+from metrics import upstream_span
+from rate_limiter import RATE_LIMIT, get_limiter, is_throttled
+from spotify_client import (
+    RETRY_STATUS_CODES, SPOTIFY_API_URL, SPOTIFY_POOL_MAXSIZE, SPOTIFY_RETRIES, SPOTIFY_TIMEOUT
+)
+
+logger = logging.getLogger('moosic.async_spotify')
+
+RETRY_BACKOFF = 0.3  # Same backoff factor as the sync session's retries
+
+
+class AsyncSpotify:
+    """The Spotify Web API calls the recommendation tiers make, as coroutines.
+
+    Method names and arguments match spotipy's, so the async tiers read like
+    the sync ones. Errors are raised as spotipy's SpotifyException.
+    """
+
+    def __init__(self, auth, prefix=SPOTIFY_API_URL):
+        self._auth = auth
+        self.prefix = prefix
+
+    async def _get(self, url, **params):
+        if not url.startswith('http'):
+            url = self.prefix + url
+        params = {key: value for key, value in params.items() if value is not None}
+        headers = {'Authorization': f'Bearer {self._auth}'}
+        operation = operation_for(url)
+        # Same order as the sync client: rate limit, circuit breaker, timing
+        if not RATE_LIMIT:
+            with guarded(operation), upstream_span(operation):
+                return await self._send(url, params, headers)
+        limiter = get_limiter()
+        for attempt in range(SPOTIFY_RETRIES + 1):
+            await limiter.acquire_async()
+            try:
+                with guarded(operation), upstream_span(operation):
+                    return await self._send(url, params, headers)
+            except SpotifyException as e:
+                if not is_throttled(e):
+                    raise
+                limiter.throttled_by_spotify(operation, e)
+                if attempt == SPOTIFY_RETRIES:
+                    raise
+
+    async def _send(self, url, params, headers):
+        """One GET, retried with backoff on connection errors and RETRY_STATUS_CODES"""
+        session = get_session()
+        for attempt in range(SPOTIFY_RETRIES + 1):
+            try:
+                async with session.get(url, params=params, headers=headers) as response:
+                    if response.status < 400:
+                        return await response.json(content_type=None)
+                    retryable = response.status in RETRY_STATUS_CODES
+                    if retryable and attempt < SPOTIFY_RETRIES:
+                        logger.debug("Retrying %s after HTTP %s", url, response.status)
+                        await asyncio.sleep(_retry_delay(response, attempt))
+                        continue
+                    raise await _spotify_error(response)
+            except aiohttp.ClientConnectionError:
+                if attempt >= SPOTIFY_RETRIES:
+                    raise
+                await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+    async def current_user(self):
+        return await self._get('me')
+
+    async def current_user_top_tracks(self, limit=20, offset=0, time_range='medium_term'):
+        return await self._get('me/top/tracks', time_range=time_range, limit=limit, offset=offset)
+
+    async def recommendation_genre_seeds(self):
+        return await self._get('recommendations/available-genre-seeds')
+
+    async def recommendations(self, seed_artists=None, seed_genres=None, seed_tracks=None, limit=20, country=None, **kwargs):
+        params = {'limit': limit, 'market': country}
+        if seed_artists:
+            params['seed_artists'] = ','.join(seed_artists)
+        if seed_genres:
+            params['seed_genres'] = ','.join(seed_genres)
+        if seed_tracks:
+            params['seed_tracks'] = ','.join(seed_tracks)
+        for attribute, value in kwargs.items():
+            if attribute.startswith(('min_', 'max_', 'target_')):
+                params[attribute] = value
+        return await self._get('recommendations', **params)
+
+    async def featured_playlists(self, locale=None, country=None, timestamp=None, limit=20, offset=0):
+        return await self._get(
+            'browse/featured-playlists',
+            locale=locale, country=country, timestamp=timestamp, limit=limit, offset=offset
+        )
+
+    async def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        return await self._get(
+            f'playlists/{playlist_id}/tracks',
+            fields=fields, limit=limit, offset=offset, market=market, additional_types='track'
+        )
+
+    async def new_releases(self, country=None, limit=20, offset=0):
+        return await self._get('browse/new-releases', country=country, limit=limit, offset=offset)
+
+    async def audio_features(self, tracks=None):
+        if tracks is None:
+            tracks = []
+        elif isinstance(tracks, str):
+            tracks = [tracks]  # Like spotipy, a single id is accepted too
+        results = await self._get('audio-features', ids=','.join(tracks))
+        # Like spotipy, return the list of feature objects
+        return results.get('audio_features', []) if results else []
+
+    async def album_tracks(self, album_id, limit=50, offset=0, market=None):
+        return await self._get(f'albums/{album_id}/tracks', limit=limit, offset=offset, market=market)
+
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    backoff = RETRY_BACKOFF * (2 ** attempt)
+    try:
+        return max(backoff, float(retry_after)) if retry_after else backoff
+    except ValueError:
+        return backoff
+
+
+async def _spotify_error(response):
+    try:
+        body = await response.json(content_type=None)
+        error = body.get('error') or {}
+        message = error.get('message', 'error') if isinstance(error, dict) else str(error)
+    except (ValueError, AttributeError, aiohttp.ContentTypeError):
+        message = 'error'
+    return SpotifyException(
+        response.status, -1, f"{response.url}:\n {message}",
+        reason=response.reason, headers=dict(response.headers)
+    )
+
+
+# Every async request in a worker process runs on one event loop in a
+# background thread, sharing one aiohttp session (and its connection pool)
+_loop = None
+_loop_pid = None
+_session = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Return this process's event loop, starting its thread on first use or after a fork"""
+    global _loop, _loop_pid, _session
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _session = None
+            threading.Thread(target=_loop.run_forever, name='spotify-async-loop', daemon=True).start()
+        return _loop
+
+
+@atexit.register
+def _close_session():
+    if _session is not None and _loop_pid == os.getpid() and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(5)
+
+
+def get_session():
+    """Return the shared aiohttp session; only call this from the engine's loop"""
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=SPOTIFY_POOL_MAXSIZE),
+            timeout=aiohttp.ClientTimeout(total=SPOTIFY_TIMEOUT)
+        )
+    return _session
+
+
+def run_coroutine(coro, timeout=None):
+    """Run coro on the engine's loop and wait for its result from a worker thread"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+def make_async_client(access_token):
+    """Build an async Spotify client for one user's access token"""
+    return AsyncSpotify(access_token)
@@ -0,0 +1,61 @@
+"""Filter and query latency of the local catalog for every mood.
+
+Builds a synthetic catalog (3 million tracks by default) unless --path
+points at an existing one, then times, per mood in MOOD_FEATURES:
+the range filter alone, the full query (filter, distance, top-N ranking)
+and turning the result rows into CompactTracks.
+
+Usage: python benchmarks/catalog_query_bench.py [--path DIR] [--rows N] [--limit N] [--repeat N]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog, build_synthetic_catalog  # noqa: E402
+from recommendations import MOOD_FEATURES, RECOMMENDATION_POOL_SIZE  # noqa: E402
+
+
+def timed(fn, repeat):
+    """Return (result, median ms, first-call ms)"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(times), times[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', help='existing catalog directory (default: build a synthetic one)')
+    parser.add_argument('--rows', type=int, default=3000000)
+    parser.add_argument('--limit', type=int, default=RECOMMENDATION_POOL_SIZE)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        path = args.path
+        if not path or not os.path.exists(os.path.join(path, 'meta.json')):
+            path = path or os.path.join(scratch, 'catalog')
+            started = time.perf_counter()
+            build_synthetic_catalog(path, args.rows)
+            print(f"Built {args.rows} synthetic tracks in {time.perf_counter() - started:.1f} s")
+
+        started = time.perf_counter()
+        catalog = Catalog(path)
+        print(f"Opened {len(catalog)} tracks in {(time.perf_counter() - started) * 1000:.2f} ms")
+        print(f"{'mood':>10} {'matches':>9} {'filter ms':>10} {'query ms':>9} {'first ms':>9} {'tracks ms':>10}")
+        for mood, features in MOOD_FEATURES.items():
+            mask, filter_ms, _ = timed(lambda: catalog.filter(features), args.repeat)
+            rows, query_ms, first_ms = timed(lambda: catalog.query(features, args.limit), args.repeat)
+            _, tracks_ms, _ = timed(lambda: catalog.tracks(rows), args.repeat)
+            print(f"{mood:>10} {int(mask.sum()):>9} {filter_ms:>10.2f} {query_ms:>9.2f} {first_ms:>9.2f} {tracks_ms:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
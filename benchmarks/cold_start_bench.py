@@ -0,0 +1,104 @@
+"""Cold-start cost of the app: import time and first-request latency, eager vs LAZY_INIT.
+
+Each measurement runs in a fresh interpreter, as a serverless cold start
+would. `python -X importtime` gives the import cost of app.py and of its
+largest dependencies; the first request to each route is then timed in the
+same process, with the Spotify API pointed at an address that refuses
+connections (no route below should need it to answer).
+
+Usage: python benchmarks/cold_start_bench.py [--runs N] [--route /health ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Top-level packages whose cumulative import time is reported
+WATCHED = ('flask', 'spotipy', 'requests', 'numpy', 'recommendations', 'aiohttp')
+
+# Marks the end of `import app` in the child's -X importtime output
+IMPORTED = '--- app imported'
+
+# Runs in the child: import the app, then time the first request to each route
+CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+print('%s', file=sys.stderr, flush=True)
+""" % IMPORTED + r"""
+client = app.app.test_client()
+firsts = {}
+for route in sys.argv[1:]:
+    started = time.perf_counter()
+    response = client.get(route)
+    loaded = [name for name in ('spotipy', 'numpy') if name in sys.modules]
+    firsts[route] = (time.perf_counter() - started, response.status_code, loaded)
+print(json.dumps({'import': imported, 'first': firsts}))
+"""
+
+
+def parse_importtime(stderr):
+    """Cumulative seconds of the watched modules imported by `import app` itself"""
+    cumulative = {}
+    for line in stderr.splitlines():
+        if line == IMPORTED:
+            break
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        cumulative_us, name = (part.strip() for part in line.split('|')[1:])
+        if name in WATCHED:
+            cumulative[name] = max(cumulative.get(name, 0), int(cumulative_us) / 1e6)
+    return cumulative
+
+
+def run_once(lazy, routes):
+    env = dict(os.environ)
+    env.update({
+        'LAZY_INIT': '1' if lazy else '0',
+        'SPOTIFY_API_URL': 'http://127.0.0.1:9/v1/',  # Nothing listens on the discard port
+        'SPOTIFY_CLIENT_ID': env.get('SPOTIFY_CLIENT_ID', 'cold-start'),
+        'SPOTIFY_CLIENT_SECRET': env.get('SPOTIFY_CLIENT_SECRET', 'cold-start'),
+        'SPOTIFY_REDIRECT_URI': env.get('SPOTIFY_REDIRECT_URI', 'http://127.0.0.1/callback'),
+        'FLASK_SECRET_KEY': env.get('FLASK_SECRET_KEY', 'cold-start'),
+        'APP_LOG_PATH': os.devnull,
+        'LOG_LEVEL': 'ERROR',
+    })
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD, *routes],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['modules'] = parse_importtime(result.stderr)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per mode (medians are reported)')
+    parser.add_argument('--route', action='append', dest='routes',
+                        help='routes to request, in order (default: / /static/script.js /health)')
+    args = parser.parse_args()
+    routes = args.routes or ['/', '/static/script.js', '/health']
+
+    for lazy in (False, True):
+        runs = [run_once(lazy, routes) for _ in range(args.runs)]
+        print(f"LAZY_INIT={int(lazy)} ({args.runs} cold starts, medians)")
+        print(f"  import app: {statistics.median(run['import'] for run in runs) * 1000:.1f} ms")
+        for name in WATCHED:
+            times = [run['modules'][name] for run in runs if name in run['modules']]
+            if times:
+                print(f"    {name:<16} {statistics.median(times) * 1000:>7.1f} ms of it")
+        for route in routes:
+            seconds = statistics.median(run['first'][route][0] for run in runs)
+            _, status, loaded = runs[0]['first'][route]
+            print(f"  first GET {route:<20} {seconds * 1000:>7.1f} ms (status {status}; "
+                  f"loaded so far: {', '.join(loaded) or 'neither spotipy nor numpy'})")
+
+
+if __name__ == '__main__':
+    main()
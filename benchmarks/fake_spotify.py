@@ -0,0 +1,325 @@
+"""A local stand-in for the Spotify Web API endpoints the recommendation tiers call.
+
+Responses are synthetic but shaped like Spotify's. Each endpoint can be
+given a fixed latency, a share of 500 errors and a share of 429 responses
+(with Retry-After), so benchmarks and load tests see realistic waits and
+failures without touching the network. With --rate-limit the server also
+enforces a per-second call budget the way Spotify does per app: once it is
+exceeded, every call gets a 429 until Retry-After has passed. GET /_stats
+returns per-endpoint counters.
+
+    python benchmarks/fake_spotify.py --port 8900 --latency 0.05 \
+        --endpoint-latency recommendations=0.2 --endpoint-error-rate featured_playlists=1 \
+        --throttle-rate 0.02 --rate-limit 30
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import itertools
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+GENRES = [
+    "acoustic", "alt-rock", "ambient", "blues", "chill", "classical", "dance", "disco", "edm",
+    "electronic", "hard-rock", "happy", "hip-hop", "indie", "jazz", "metal", "piano", "pop",
+    "r-n-b", "rock", "rock-n-roll", "sad", "singer-songwriter", "soul", "study", "work-out",
+]
+
+# (endpoint name, path pattern)
+ROUTES = [
+    ('genre_seeds', re.compile(r'^/v1/recommendations/available-genre-seeds$')),
+    ('recommendations', re.compile(r'^/v1/recommendations$')),
+    ('top_tracks', re.compile(r'^/v1/me/top/tracks$')),
+    ('me', re.compile(r'^/v1/me$')),
+    ('featured_playlists', re.compile(r'^/v1/browse/featured-playlists$')),
+    ('playlist_tracks', re.compile(r'^/v1/playlists/(?P<id>[^/]+)/tracks$')),
+    ('new_releases', re.compile(r'^/v1/browse/new-releases$')),
+    ('album_tracks', re.compile(r'^/v1/albums/(?P<id>[^/]+)/tracks/?$')),
+    ('audio_features', re.compile(r'^/v1/audio-features/?$')),
+]
+
+_track_ids = itertools.count()
+
+
+def _album(album_id):
+    return {
+        'id': album_id,
+        'name': f'Album {album_id}',
+        'images': [{'url': f'https://i.scdn.co/image/{album_id}', 'height': 640, 'width': 640}],
+    }
+
+
+def _track(album=True):
+    number = next(_track_ids)
+    track_id = f'fake{number:012d}'
+    track = {
+        'id': track_id,
+        'name': f'Track {number}',
+        'artists': [{'id': f'artist{number % 500}', 'name': f'Artist {number % 500}'}],
+        'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+        'duration_ms': 200000,
+        'popularity': 50,
+    }
+    if album:
+        track['album'] = _album(f'album{number % 1000}')
+    return track
+
+
+def _audio_features(track_id):
+    """Stable pseudo-random features for a track id"""
+    digest = hashlib.blake2b(track_id.encode(), digest_size=7).digest()
+    values = [byte / 255 for byte in digest]
+    return {
+        'id': track_id,
+        'valence': values[0],
+        'energy': values[1],
+        'tempo': 60 + values[2] * 120,
+        'instrumentalness': values[3],
+        'speechiness': values[4] * 0.5,
+        'acousticness': values[5],
+        'danceability': values[6],
+    }
+
+
+def _limit(query, default):
+    return int(query.get('limit', [default])[0])
+
+
+def respond(endpoint, query):
+    """Build the JSON body for one endpoint"""
+    if endpoint == 'genre_seeds':
+        return {'genres': GENRES}
+    if endpoint == 'recommendations':
+        return {'tracks': [_track() for _ in range(_limit(query, 20))], 'seeds': []}
+    if endpoint == 'top_tracks':
+        return {'items': [_track() for _ in range(_limit(query, 20))]}
+    if endpoint == 'me':
+        return {'id': 'fake-user', 'display_name': 'Fake User', 'images': []}
+    if endpoint == 'featured_playlists':
+        items = [{'id': f'playlist{i}', 'name': f'Playlist {i}'} for i in range(_limit(query, 20))]
+        return {'message': 'Featured', 'playlists': {'items': items}}
+    if endpoint == 'playlist_tracks':
+        return {'items': [{'track': _track()} for _ in range(_limit(query, 100))]}
+    if endpoint == 'new_releases':
+        return {'albums': {'items': [_album(f'release{i}') for i in range(_limit(query, 20))]}}
+    if endpoint == 'album_tracks':
+        return {'items': [_track(album=False) for _ in range(_limit(query, 50))]}
+    if endpoint == 'audio_features':
+        ids = query.get('ids', [''])[0].split(',')
+        return {'audio_features': [_audio_features(track_id) for track_id in ids if track_id]}
+    raise KeyError(endpoint)
+
+
+class FakeSpotifyServer:
+    """Serves the fake API on its own event loop thread; use as a context manager.
+
+    latency, error_rate and throttle_rate apply to every endpoint unless the
+    endpoint_* dicts (keyed by the endpoint names in ROUTES) override them.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, endpoint_latency=None,
+                 error_rate=0.0, endpoint_error_rate=None, throttle_rate=0.0, endpoint_throttle_rate=None,
+                 retry_after=1, rate_limit=None, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.endpoint_latency = dict(endpoint_latency or {})
+        self.error_rate = error_rate
+        self.endpoint_error_rate = dict(endpoint_error_rate or {})
+        self.throttle_rate = throttle_rate
+        self.endpoint_throttle_rate = dict(endpoint_throttle_rate or {})
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit  # Calls per second over all endpoints, or None
+        self._recent = collections.deque()  # Arrival times within the last second
+        self._limited_until = 0.0
+        self.requests = 0
+        self.stats = {}  # endpoint -> {'requests': n, 'errors': n, 'throttled': n}
+        self._random = random.Random(seed)
+        self._loop = None
+        self._runner = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/v1/'
+
+    def _over_rate_limit(self):
+        now = time.monotonic()
+        if now < self._limited_until:
+            return True
+        self._recent.append(now)
+        while self._recent[0] <= now - 1:
+            self._recent.popleft()
+        if len(self._recent) > self.rate_limit:
+            self._limited_until = now + self.retry_after
+            return True
+        return False
+
+    async def handle(self, request):
+        if request.path == '/_stats':
+            return web.json_response(self.stats)
+        for endpoint, pattern in ROUTES:
+            if pattern.match(request.path):
+                break
+        else:
+            return web.json_response({'error': {'status': 404, 'message': 'Service not found'}}, status=404)
+        self.requests += 1
+        stats = self.stats.setdefault(endpoint, {'requests': 0, 'errors': 0, 'throttled': 0})
+        stats['requests'] += 1
+        delay = self.endpoint_latency.get(endpoint, self.latency)
+        if delay:
+            await asyncio.sleep(delay)
+        roll = self._random.random()
+        throttle_rate = self.endpoint_throttle_rate.get(endpoint, self.throttle_rate)
+        if (self.rate_limit and self._over_rate_limit()) or roll < throttle_rate:
+            stats['throttled'] += 1
+            return web.json_response(
+                {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                status=429,
+                headers={'Retry-After': str(self.retry_after)}
+            )
+        if roll < throttle_rate + self.endpoint_error_rate.get(endpoint, self.error_rate):
+            stats['errors'] += 1
+            return web.json_response({'error': {'status': 500, 'message': 'Server error'}}, status=500)
+        query = {key: request.query.getall(key) for key in request.query.keys()}
+        return web.json_response(respond(endpoint, query))
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/{path:.*}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port, backlog=1024)
+        await site.start()
+        if not self.port:
+            self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name='fake-spotify', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result(10)
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def serve_forever(self):
+        """Run in the calling thread until interrupted"""
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._start())
+        print(f"Fake Spotify API at {self.url}", flush=True)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.run_until_complete(self._runner.cleanup())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def endpoint_values(text):
+    """Parse 'recommendations=0.2,album_tracks=0.1' into {endpoint: float}"""
+    values = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        endpoint, _, value = item.partition('=')
+        if endpoint not in dict(ROUTES):
+            raise argparse.ArgumentTypeError(f"unknown endpoint '{endpoint}' (one of {', '.join(dict(ROUTES))})")
+        values[endpoint] = float(value)
+    return values
+
+
+def add_arguments(parser):
+    """Add the server's latency and failure options to an argument parser"""
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+    parser.add_argument('--endpoint-latency', type=endpoint_values, default={}, help='per-endpoint latency, e.g. recommendations=0.2')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of responses that are 500 errors')
+    parser.add_argument('--endpoint-error-rate', type=endpoint_values, default={}, help='per-endpoint error rate, e.g. featured_playlists=1')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of responses that are 429s')
+    parser.add_argument('--endpoint-throttle-rate', type=endpoint_values, default={}, help='per-endpoint 429 rate')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with 429s')
+    parser.add_argument('--rate-limit', type=float, default=None, help='calls per second allowed before 429s')
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def server_options(args):
+    """FakeSpotifyServer keyword arguments from parsed add_arguments() options"""
+    return {
+        'latency': args.latency,
+        'endpoint_latency': args.endpoint_latency,
+        'error_rate': args.error_rate,
+        'endpoint_error_rate': args.endpoint_error_rate,
+        'throttle_rate': args.throttle_rate,
+        'endpoint_throttle_rate': args.endpoint_throttle_rate,
+        'retry_after': args.retry_after,
+        'rate_limit': args.rate_limit,
+        'seed': args.seed,
+    }
+
+
+def command_line(options):
+    """Command-line arguments reproducing FakeSpotifyServer keyword arguments"""
+    def pairs(values):
+        return ','.join(f'{endpoint}={value}' for endpoint, value in values.items())
+
+    argv = []
+    for name, value in options.items():
+        flag = '--' + name.replace('_', '-')
+        if isinstance(value, dict):
+            if value:
+                argv += [flag, pairs(value)]
+        elif value is not None:
+            argv += [flag, str(value)]
+    return argv
+
+
+def start_subprocess(**options):
+    """Run the fake API in its own process, so it doesn't share the caller's GIL.
+
+    Takes FakeSpotifyServer keyword arguments; returns (process, API url).
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, __file__, '--port', str(port), *command_line(options)],
+        stdout=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise
+            time.sleep(0.05)
+    return process, f'http://127.0.0.1:{port}/v1/'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        FakeSpotifyServer(args.host, args.port, **server_options(args)).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Load test for /analyze_mood against a local fake Spotify API.
+
+Starts benchmarks/fake_spotify.py in its own process (with the latency,
+error and 429 options below), points the app at it with SPOTIFY_API_URL,
+and sends concurrent /analyze_mood requests through Flask test clients that
+carry a logged-in session. Reports throughput and p50/p95/p99 latency per
+winning source tier, so changes to analyze_mood, get_spotify_client and the
+fallback cascade can be checked for regressions offline.
+
+    python benchmarks/load_test.py --requests 500 --concurrency 16
+    python benchmarks/load_test.py --endpoint-error-rate recommendations=1 --throttle-rate 0.05
+    UPSTREAM_ENGINE=async RECOMMENDATION_MODE=hedged python benchmarks/load_test.py
+
+App settings (UPSTREAM_ENGINE, RECOMMENDATION_MODE, RECOMMENDATION_CACHE_BYTES,
+...) are read from the environment as usual.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_spotify  # noqa: E402
+import rate_limiter  # noqa: E402
+
+# One text per mood category, sent round-robin
+TEXTS = [
+    "I feel so happy today",
+    "I am sad and lonely",
+    "feeling relaxed and calm",
+    "I need energy for my workout",
+    "I need to focus on studying",
+    "I am so angry right now",
+    "I feel nostalgic about the old days",
+]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def import_app(api_url):
+    """Import the app configured for the fake API (settings are read at import time)"""
+    os.environ['SPOTIFY_API_URL'] = api_url
+    for name, value in (
+        ('SPOTIFY_CLIENT_ID', 'load-test'),
+        ('SPOTIFY_CLIENT_SECRET', 'load-test'),
+        ('SPOTIFY_REDIRECT_URI', 'http://127.0.0.1/callback'),
+        ('FLASK_SECRET_KEY', 'load-test'),
+        ('APP_LOG_PATH', os.devnull),
+        ('LOG_LEVEL', 'ERROR'),
+    ):
+        os.environ.setdefault(name, value)
+    import app
+    # Only the summary should reach the console
+    app.logger.setLevel(os.environ['LOG_LEVEL'])
+    logging.getLogger('spotipy').setLevel(logging.CRITICAL)
+    return app
+
+
+def logged_in_client(app_module, user):
+    """A test client whose session holds a token that won't need refreshing"""
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['token_info'] = {
+            'access_token': f'load-test-access-{user}',
+            'refresh_token': f'load-test-refresh-{user}',
+            'expires_at': int(time.time()) + 24 * 3600,
+        }
+    return client
+
+
+def run(app_module, requests, concurrency, path):
+    """Send the requests; returns (elapsed seconds, [(status, source, seconds)])"""
+    local = threading.local()
+    users = iter(range(concurrency * 4))
+    users_lock = threading.Lock()
+
+    def one(index):
+        client = getattr(local, 'client', None)
+        if client is None:
+            with users_lock:
+                user = next(users)
+            client = local.client = logged_in_client(app_module, user)
+        started = time.perf_counter()
+        response = client.post(path, json={'text': TEXTS[index % len(TEXTS)]})
+        body = response.get_data()
+        elapsed = time.perf_counter() - started
+        source = None
+        if response.status_code == 200:
+            if path.endswith('/stream'):
+                events = [json.loads(line) for line in body.splitlines() if line]
+                source = next((event.get('source') for event in events if event['type'] == 'done'), None)
+            else:
+                source = json.loads(body).get('source')
+        return response.status_code, source or f'http_{response.status_code}', elapsed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as workers:
+        results = list(workers.map(one, range(requests)))
+    return time.perf_counter() - started, results
+
+
+def report(elapsed, results):
+    by_source = {}
+    for _, source, seconds in results:
+        by_source.setdefault(source, []).append(seconds)
+    print(f"{len(results)} requests in {elapsed:.2f}s: {len(results) / elapsed:.1f} req/s")
+    print(f"{'source':<32} {'count':>6} {'share':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for source, latencies in sorted(by_source.items(), key=lambda item: -len(item[1])):
+        latencies.sort()
+        print(
+            f"{source:<32} {len(latencies):>6} {len(latencies) / len(results):>6.0%} "
+            f"{percentile(latencies, 0.50) * 1000:>8.1f} {percentile(latencies, 0.95) * 1000:>8.1f} "
+            f"{percentile(latencies, 0.99) * 1000:>8.1f}"
+        )
+    everything = sorted(seconds for _, _, seconds in results)
+    print(
+        f"{'all':<32} {len(everything):>6} {1:>6.0%} {percentile(everything, 0.50) * 1000:>8.1f} "
+        f"{percentile(everything, 0.95) * 1000:>8.1f} {percentile(everything, 0.99) * 1000:>8.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight at once')
+    parser.add_argument('--warmup', type=int, default=20, help='requests sent before measuring')
+    parser.add_argument('--path', default='/analyze_mood', choices=['/analyze_mood', '/analyze_mood/stream'])
+    fake_spotify.add_arguments(parser)
+    args = parser.parse_args()
+
+    process, api_url = fake_spotify.start_subprocess(**fake_spotify.server_options(args))
+    try:
+        app_module = import_app(api_url)
+        if args.warmup:
+            run(app_module, args.warmup, min(args.concurrency, args.warmup), args.path)
+        elapsed, results = run(app_module, args.requests, args.concurrency, args.path)
+        print(
+            f"engine={app_module.UPSTREAM_ENGINE} mode={os.getenv('RECOMMENDATION_MODE', 'sequential')} "
+            f"concurrency={args.concurrency} fake latency={args.latency * 1000:.0f} ms"
+        )
+        report(elapsed, results)
+        print("circuits: " + ', '.join(
+            f"{operation} {stats['state']}" for operation, stats in sorted(app_module.circuit_stats().items())
+        ))
+        limiter = rate_limiter.rate_limit_stats()
+        if limiter:
+            print("rate limiter: " + ', '.join(f"{name} {value}" for name, value in limiter.items()))
+        with urllib.request.urlopen(api_url.replace('/v1/', '/_stats')) as response:
+            stats = json.load(response)
+        print("fake Spotify calls, warm-up included: " + ', '.join(
+            f"{endpoint} {counts['requests']} ({counts['errors']} errors, {counts['throttled']} 429s)"
+            for endpoint, counts in sorted(stats.items())
+        ))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Per-request logging overhead on the request thread, before and after logging_setup.
+
+Replays the log lines a sequential /analyze_mood request writes when tier 1
+succeeds after its five attempts (mood lines, genre/feature dumps, per-attempt
+lines) and measures the CPU time they take on the calling thread (the listener
+thread's work is not counted):
+
+    eager    the old setup: DEBUG forced on, f-strings, a FileHandler with
+             per-record regex redaction on the request thread
+    info     logging_setup with the default LOG_LEVEL=INFO
+    debug    logging_setup with LOG_LEVEL=DEBUG (queued writes, sampled attempt lines)
+
+Usage: python benchmarks/logging_bench.py [--requests N]
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging_setup  # noqa: E402
+
+GENRES = ['happy', 'pop']
+FEATURES = {'min_valence': 0.7, 'min_energy': 0.7, 'target_tempo': 120}
+SEEDS = ['genre-%d' % i for i in range(120)]
+TOKEN = 'BQD' + 'x' * 160
+
+
+class OldSensitiveDataFilter(logging.Filter):
+    """The filter app.py used before logging_setup"""
+
+    def filter(self, record):
+        if record.getMessage():
+            message = record.getMessage()
+            if 'Bearer ' in message:
+                record.msg = re.sub(r'Bearer [A-Za-z0-9_-]+', 'Bearer [REDACTED]', record.msg)
+            record.msg = re.sub(r'[A-Za-z0-9_-]{50,}', '[REDACTED]', record.msg)
+        return True
+
+
+def eager_request(logger, attempts):
+    logger.debug(f"Using access token ending with: ...{TOKEN[-8:]}")
+    logger.debug(f"Analyzing mood text: {'I feel great today'}")
+    logger.debug(f"Mood analysis result: {'You seem happy and upbeat!'}")
+    logger.debug(f"Selected genre: {'pop'}")
+    logger.debug(f"Mood category: {'happy'}")
+    logger.debug(f"Available genres: {SEEDS}")
+    logger.debug(f"Trying advanced recommendations for mood: {'happy'}")
+    logger.debug(f"Using genres: {GENRES} with audio features: {FEATURES}")
+    for index in range(attempts):
+        logger.debug(f"Attempt {index + 1}: Calling Spotify recommendations API with genres={GENRES}, features={FEATURES}")
+        logger.debug(f"Attempt {index + 1}: Found {4} valid tracks")
+    logger.debug(f"Successfully got {12} advanced recommendations")
+
+
+def lazy_request(logger, attempt_logger, attempts):
+    logger.debug("Using access token ending with: ...%s", TOKEN[-8:])
+    logger.debug("Analyzing mood text: %s", 'I feel great today')
+    logger.debug("Mood analysis result: %s", 'You seem happy and upbeat!')
+    logger.debug("Selected genre: %s", 'pop')
+    logger.debug("Mood category: %s", 'happy')
+    logger.debug("Trying advanced recommendations for mood: %s", 'happy')
+    logger.debug("Using genres: %s with audio features: %s", GENRES, FEATURES)
+    for index in range(attempts):
+        attempt_logger.debug("Attempt %s: Calling Spotify recommendations API with genres=%s, features=%s", index + 1, GENRES, FEATURES)
+        attempt_logger.debug("Attempt %s: Found %s valid tracks", index + 1, 4)
+    logger.debug("Successfully got %s advanced recommendations", 12)
+
+
+def reset(logger_names):
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging_setup.BackgroundQueueHandler):
+                handler.stop()
+            logger.removeHandler(handler)
+            handler.close()
+        logger.filters.clear()
+
+
+def run_eager(path, requests):
+    logger = logging.getLogger('moosic')
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(logging_setup.LOG_FORMAT))
+    handler.addFilter(OldSensitiveDataFilter())
+    logger.addHandler(handler)
+    started = time.thread_time()
+    for _ in range(requests):
+        eager_request(logger, 5)
+    return time.thread_time() - started
+
+
+def run_lazy(path, requests, level):
+    logging_setup.LOG_LEVEL = level
+    logger = logging_setup.configure_logging(path)
+    # Only the file handler: the console would dominate both setups alike
+    queue_handler = logger.handlers[0]
+    queue_handler.target_handlers = queue_handler.target_handlers[1:]
+    attempt_logger = logging.getLogger(logging_setup.ATTEMPTS_LOGGER)
+    started = time.thread_time()
+    for _ in range(requests):
+        lazy_request(logger, attempt_logger, 5)
+    elapsed = time.thread_time() - started
+    queue_handler.stop()  # Not timed: happens on the listener thread
+    return elapsed, queue_handler.dropped
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    names = ['moosic', logging_setup.ATTEMPTS_LOGGER]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'app.log')
+        print(f"{args.requests} simulated requests, about 18 debug lines each")
+        print(f"{'setup':>6} {'us/request':>11} {'log bytes/request':>18}  dropped")
+        for setup in ('eager', 'info', 'debug'):
+            reset(names)
+            open(path, 'w').close()
+            dropped = 0
+            if setup == 'eager':
+                elapsed = run_eager(path, args.requests)
+            else:
+                elapsed, dropped = run_lazy(path, args.requests, setup.upper())
+            size = os.path.getsize(path)
+            print(f"{setup:>6} {elapsed / args.requests * 1e6:>11.1f} {size / args.requests:>18.0f}  {dropped}")
+        reset(names)
+
+
+if __name__ == '__main__':
+    main()
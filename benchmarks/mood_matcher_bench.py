@@ -0,0 +1,70 @@
+"""Micro-benchmark for the mood matcher over long inputs.
+
+Compares the single-pass compiled matcher in mood_analyzer against the old
+implementation that ran one regex per mood keyword plus several phrase scans.
+
+Usage: python benchmarks/mood_matcher_bench.py [--repeat N]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mood_analyzer import MOOD_MAP, MOOD_PHRASES, score_moods  # noqa: E402
+
+
+def legacy_match(text):
+    """The matcher as it was before: one re.search per keyword, then phrase scans."""
+    text = text.lower()
+    matched_moods = []
+    for mood in MOOD_MAP:
+        if re.search(r'\b' + mood + r'\b', text):
+            matched_moods.append(mood)
+    if not matched_moods:
+        for mood, phrases in MOOD_PHRASES.items():
+            if any(phrase in text for phrase in phrases):
+                matched_moods.append(mood)
+                break
+    return matched_moods
+
+
+FILLER = (
+    "today was long and the weather kept changing while I walked around town "
+    "thinking about what to listen to on the way home from the office "
+).split()
+
+
+def make_text(words, keyword=None, seed=0):
+    rng = random.Random(seed)
+    tokens = [rng.choice(FILLER) for _ in range(words)]
+    if keyword:
+        tokens[rng.randrange(words)] = keyword
+    return ' '.join(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [
+        ('no mood words', None),
+        ('one keyword', 'nostalgic'),
+        ('one phrase', 'wind down'),
+    ]
+    print(f"{'case':<16}{'words':>8}{'legacy us':>12}{'compiled us':>13}{'speedup':>9}")
+    for words in (50, 500, 5000, 50000):
+        for label, keyword in cases:
+            text = make_text(words, keyword)
+            number = max(1, 20000 // words)
+            legacy = min(timeit.repeat(lambda: legacy_match(text), number=number, repeat=args.repeat)) / number
+            compiled = min(timeit.repeat(lambda: score_moods(text), number=number, repeat=args.repeat)) / number
+            print(f"{label:<16}{words:>8}{legacy * 1e6:>12.1f}{compiled * 1e6:>13.1f}{legacy / compiled:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Per-request session cost: Flask's signed cookie vs the SQLite session store.
+
+For a session holding a Spotify token_info, reports the cookie the browser
+sends on every request, the time to open the session from it (what every
+route pays), and the time to save it after a token refresh.
+
+Usage: python benchmarks/session_bench.py [--requests N]
+"""
+import argparse
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from flask.sessions import SecureCookieSessionInterface  # noqa: E402
+
+from session_store import ServerSessionInterface, SessionStore  # noqa: E402
+
+TOKEN_INFO = {
+    'access_token': 'BQ' + secrets.token_urlsafe(160),
+    'token_type': 'Bearer',
+    'expires_in': 3600,
+    'refresh_token': 'AQ' + secrets.token_urlsafe(100),
+    'scope': 'playlist-read-private user-library-read user-read-email user-read-private user-top-read',
+    'expires_at': int(time.time()) + 3600,
+}
+
+
+def cookie_for(app):
+    """The session cookie value a logged-in browser would send"""
+    with app.test_request_context('/callback') as context:
+        interface = app.session_interface
+        session = interface.open_session(app, context.request)
+        session['token_info'] = TOKEN_INFO
+        response = app.response_class()
+        interface.save_session(app, session, response)
+        return response.headers['Set-Cookie'].split(';', 1)[0].split('=', 1)[1]
+
+
+def measure(app, requests):
+    """(cookie, seconds per open, seconds per save after a token refresh)"""
+    cookie = cookie_for(app)
+    interface = app.session_interface
+    with app.test_request_context('/analyze_mood', headers={'Cookie': f'session={cookie}'}) as context:
+        started = time.perf_counter()
+        for _ in range(requests):
+            session = interface.open_session(app, context.request)
+            session['token_info']['access_token']
+        opened = (time.perf_counter() - started) / requests
+
+        refreshed = dict(TOKEN_INFO, access_token='BQ' + secrets.token_urlsafe(160))
+        started = time.perf_counter()
+        for _ in range(requests):
+            session = interface.open_session(app, context.request)
+            session['token_info'] = refreshed
+            interface.save_session(app, session, app.response_class())
+        saved = (time.perf_counter() - started) / requests - opened
+    return cookie, opened, saved
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'backend':<8} {'cookie bytes':>12} {'open us':>8} {'save us':>8}")
+        for backend in ('cookie', 'sqlite'):
+            app = Flask(__name__)
+            app.secret_key = 'session-bench'
+            if backend == 'sqlite':
+                app.session_interface = ServerSessionInterface(SessionStore(os.path.join(directory, 'sessions.db')))
+            else:
+                app.session_interface = SecureCookieSessionInterface()
+            cookie, opened, saved = measure(app, args.requests)
+            print(f"{backend:<8} {len(cookie):>12} {opened * 1e6:>8.1f} {saved * 1e6:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
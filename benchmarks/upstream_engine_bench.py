@@ -0,0 +1,102 @@
+"""Throughput of the sync and async upstream engines against a local fake Spotify API.
+
+Each simulated request runs the full recommendation path (genre seeds plus
+the five tier-1 attempts) the way /analyze_mood does, from a pool of worker
+threads standing in for the web server's. The pool cache is disabled so
+every request goes upstream. Both engines are capped by the connection
+pool size (SPOTIFY_POOL_MAXSIZE), and the sync engine also by its
+fan-out threads (FANOUT_POOL_SIZE); raise both to compare them uncapped.
+
+Usage: python benchmarks/upstream_engine_bench.py [--requests N] [--latency S] [--concurrency 8,32,128]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('RECOMMENDATION_CACHE_BYTES', '0')
+# Measure the engines, not the shared rate limit (on by default at 25 calls/s)
+os.environ.setdefault('RATE_LIMIT', '0')
+
+import async_recommendations  # noqa: E402
+import fake_spotify  # noqa: E402
+from async_spotify import AsyncSpotify, run_coroutine  # noqa: E402
+from recommendations import RecommendationContext, get_recommendations  # noqa: E402
+from spotify_client import make_client  # noqa: E402
+
+MOODS = [('happy', 'pop'), ('sad', 'sad'), ('relaxed', 'chill'), ('energetic', 'edm'), ('focused', 'study')]
+
+
+def sync_request(api_url, index):
+    sp = make_client('fake-token')
+    sp.prefix = api_url
+    mood, genre = MOODS[index % len(MOODS)]
+    return get_recommendations(RecommendationContext(sp, mood, genre))
+
+
+def async_request(api_url, index):
+    sp = AsyncSpotify('fake-token', prefix=api_url)
+    mood, genre = MOODS[index % len(MOODS)]
+    return run_coroutine(async_recommendations.get_recommendations(RecommendationContext(sp, mood, genre)))
+
+
+# Threads each engine starts for upstream calls, on top of the worker threads
+ENGINE_THREAD_PREFIXES = {'sync': 'recommendation-fanout', 'async': 'spotify-async-loop'}
+
+
+def engine_threads(engine):
+    prefix = ENGINE_THREAD_PREFIXES[engine]
+    return sum(1 for thread in threading.enumerate() if thread.name.startswith(prefix))
+
+
+def run(engine, api_url, requests, concurrency):
+    """Return (requests per second, peak engine thread count, sources seen)"""
+    request = sync_request if engine == 'sync' else async_request
+    peak_threads = 0
+    sources = {}
+    lock = threading.Lock()
+
+    def one(index):
+        nonlocal peak_threads
+        _, source = request(api_url, index)
+        with lock:
+            sources[source] = sources.get(source, 0) + 1
+            peak_threads = max(peak_threads, engine_threads(engine))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as workers:
+        list(workers.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+    return requests / elapsed, peak_threads, sources
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='fake API latency per call in seconds')
+    parser.add_argument('--concurrency', default='8,32,128', help='comma-separated worker thread counts')
+    args = parser.parse_args()
+
+    process, api_url = fake_spotify.start_subprocess(latency=args.latency)
+    try:
+        # Warm up both engines (genre seed cache, connection pools, event loop)
+        sync_request(api_url, 0)
+        async_request(api_url, 0)
+
+        print(f"{args.requests} requests per run, {args.latency * 1000:.0f} ms fake API latency")
+        print(f"{'engine':>6} {'workers':>8} {'req/s':>9} {'upstream threads':>17}  sources")
+        for concurrency in (int(c) for c in args.concurrency.split(',')):
+            for engine in ('sync', 'async'):
+                throughput, threads, sources = run(engine, api_url, args.requests, concurrency)
+                print(f"{engine:>6} {concurrency:>8} {throughput:>9.1f} {threads:>17}  {sources}")
+    finally:
+        process.terminate()
+        process.wait()
+
+if __name__ == '__main__':
+    main()
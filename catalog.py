@@ -0,0 +1,292 @@
+"""A local, memory-mapped catalog of tracks and their audio features.
+
+The catalog is a directory of raw column files plus a small meta.json:
+
+    ids.bin                  fixed-width track ids (S22)
+    <feature>.f32            one float32 column per audio feature
+    <text>.blob / .offsets   UTF-8 strings stored back to back, with int64
+                             offsets (rows + 1 of them) for name, artists
+                             and image_url
+
+Columns are opened with numpy.memmap, so a catalog of millions of tracks
+costs almost no memory until it is queried, and worker processes share
+the same pages. Build one with:
+
+    python catalog.py build tracks.csv catalog/
+    python catalog.py synthetic catalog/ --rows 3000000
+"""
+import argparse
+import csv
+import json
+import os
+import threading
+
+import numpy as np
+
+from tracks import CompactTrack
+
+CATALOG_VERSION = 1
+ID_DTYPE = 'S22'  # Spotify track ids are 22 base62 characters
+FEATURES = ('valence', 'energy', 'tempo', 'instrumentalness', 'speechiness', 'acousticness', 'danceability')
+TEXT_COLUMNS = ('name', 'artists', 'image_url')
+ARTIST_SEPARATOR = '\x1f'
+
+# Ranges used for features that only have a min_ or max_ bound, and to
+# scale distances so tempo (in BPM) doesn't outweigh the 0-1 features
+FEATURE_RANGES = {'tempo': (40.0, 220.0)}
+DEFAULT_RANGE = (0.0, 1.0)
+
+
+def mood_targets(mood_features):
+    """Target value per feature: target_ values, else the middle of the allowed range"""
+    targets = {}
+    for feature in FEATURES:
+        if f'target_{feature}' in mood_features:
+            targets[feature] = mood_features[f'target_{feature}']
+            continue
+        low, high = FEATURE_RANGES.get(feature, DEFAULT_RANGE)
+        low = mood_features.get(f'min_{feature}', low)
+        high = mood_features.get(f'max_{feature}', high)
+        if f'min_{feature}' in mood_features or f'max_{feature}' in mood_features:
+            targets[feature] = (low + high) / 2.0
+    return targets
+
+
+class CatalogWriter:
+    """Appends tracks to a new catalog in chunks; call close() to finish it"""
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.rows = 0
+        self._ids = open(os.path.join(path, 'ids.bin'), 'wb')
+        self._features = {name: open(os.path.join(path, f'{name}.f32'), 'wb') for name in FEATURES}
+        self._blobs = {name: open(os.path.join(path, f'{name}.blob'), 'wb') for name in TEXT_COLUMNS}
+        self._offsets = {name: open(os.path.join(path, f'{name}.offsets'), 'wb') for name in TEXT_COLUMNS}
+        self._blob_sizes = dict.fromkeys(TEXT_COLUMNS, 0)
+        for offsets in self._offsets.values():
+            np.zeros(1, dtype=np.int64).tofile(offsets)
+
+    def append(self, ids, features, names, artists, image_urls):
+        """Add a chunk of tracks.
+
+        ids, names and image_urls are sequences of str, artists a sequence
+        of artist-name sequences, and features maps every name in FEATURES
+        to a sequence of numbers.
+        """
+        count = len(ids)
+        np.asarray(ids, dtype=ID_DTYPE).tofile(self._ids)
+        for name in FEATURES:
+            column = np.asarray(features[name], dtype=np.float32)
+            if len(column) != count:
+                raise ValueError(f"Feature column '{name}' has {len(column)} values for {count} tracks")
+            column.tofile(self._features[name])
+        texts = {
+            'name': names,
+            'artists': [ARTIST_SEPARATOR.join(artist_names) for artist_names in artists],
+            'image_url': image_urls,
+        }
+        for name, values in texts.items():
+            encoded = [value.encode('utf-8') for value in values]
+            lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=count)
+            (self._blob_sizes[name] + np.cumsum(lengths)).tofile(self._offsets[name])
+            self._blobs[name].write(b''.join(encoded))
+            self._blob_sizes[name] += int(lengths.sum())
+        self.rows += count
+
+    def close(self):
+        files = [self._ids, *self._features.values(), *self._blobs.values(), *self._offsets.values()]
+        for handle in files:
+            handle.close()
+        meta = {'version': CATALOG_VERSION, 'rows': self.rows, 'features': list(FEATURES), 'text_columns': list(TEXT_COLUMNS)}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Catalog:
+    """Read-only view of a catalog directory with vectorized mood queries"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != CATALOG_VERSION:
+            raise ValueError(f"Unsupported catalog version {meta.get('version')} in {path}")
+        self.path = path
+        self.rows = meta['rows']
+        self.ids = self._column('ids.bin', ID_DTYPE)
+        self.features = {name: self._column(f'{name}.f32', np.float32) for name in FEATURES}
+        self._blobs = {name: self._column(f'{name}.blob', np.uint8) for name in TEXT_COLUMNS}
+        self._offsets = {name: self._column(f'{name}.offsets', np.int64) for name in TEXT_COLUMNS}
+        if len(self.ids) != self.rows or any(len(offsets) != self.rows + 1 for offsets in self._offsets.values()):
+            raise ValueError(f"Catalog at {path} is incomplete")
+
+    def _column(self, filename, dtype):
+        path = os.path.join(self.path, filename)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)  # numpy can't map an empty file
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.rows
+
+    def filter(self, mood_features):
+        """Boolean mask of the tracks within every min_/max_ bound of mood_features"""
+        mask = np.ones(self.rows, dtype=bool)
+        for key, value in mood_features.items():
+            bound, _, feature = key.partition('_')
+            if feature not in self.features:
+                continue
+            if bound == 'min':
+                mask &= self.features[feature] >= value
+            elif bound == 'max':
+                mask &= self.features[feature] <= value
+        return mask
+
+    def query(self, mood_features, limit):
+        """Row numbers of the (up to) limit tracks closest to the mood, best first.
+
+        Tracks outside the mood's bounds are dropped; the rest are ranked by
+        their scaled Euclidean distance to the mood's targets.
+        """
+        mask = self.filter(mood_features)
+        targets = mood_targets(mood_features)
+        # When nothing was filtered out, rank the columns as they are
+        # instead of gathering every row
+        rows = None if mask.all() else np.flatnonzero(mask)
+        count = self.rows if rows is None else len(rows)
+        if not count or not targets:
+            return np.flatnonzero(mask)[:limit]
+        distance = np.zeros(count, dtype=np.float32)
+        for feature, target in targets.items():
+            low, high = FEATURE_RANGES.get(feature, DEFAULT_RANGE)
+            values = self.features[feature] if rows is None else self.features[feature][rows]
+            delta = (values - np.float32(target)) / np.float32(high - low)
+            distance += delta * delta
+        if count > limit:
+            best = np.argpartition(distance, limit - 1)[:limit]
+        else:
+            best = np.arange(count)
+        best = best[np.argsort(distance[best], kind='stable')]
+        return best if rows is None else rows[best]
+
+    def text(self, column, row):
+        offsets = self._offsets[column]
+        return bytes(self._blobs[column][offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def track(self, row):
+        """Build the CompactTrack for one row"""
+        track_id = self.ids[row].decode('ascii')
+        artists = self.text('artists', row)
+        return CompactTrack(
+            track_id,
+            self.text('name', row),
+            tuple(artists.split(ARTIST_SEPARATOR)) if artists else (),
+            self.text('image_url', row),
+            f'https://open.spotify.com/track/{track_id}'
+        )
+
+    def tracks(self, rows):
+        return [self.track(int(row)) for row in rows]
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def open_catalog(path):
+    """Return the Catalog at path, opened once per process"""
+    with _catalogs_lock:
+        catalog = _catalogs.get(path)
+        if catalog is None:
+            catalog = _catalogs[path] = Catalog(path)
+        return catalog
+
+
+def _read_rows(path):
+    """Yield track dicts from a CSV file or a JSON-lines file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def build_catalog(source, path, chunk_size=100000):
+    """Build a catalog from a CSV or JSON-lines export of tracks with audio features.
+
+    Each row needs id, name, artists (names separated by ';' in CSV, or a
+    list in JSON), image_url and every audio feature in FEATURES.
+    Returns the number of tracks written.
+    """
+    def flush(writer, chunk):
+        if chunk:
+            writer.append(
+                [row['id'] for row in chunk],
+                {name: [float(row[name]) for row in chunk] for name in FEATURES},
+                [row['name'] for row in chunk],
+                [row['artists'] if isinstance(row['artists'], list) else row['artists'].split(';') for row in chunk],
+                [row.get('image_url') or '' for row in chunk]
+            )
+            chunk.clear()
+
+    with CatalogWriter(path) as writer:
+        chunk = []
+        for row in _read_rows(source):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                flush(writer, chunk)
+        flush(writer, chunk)
+        return writer.rows
+
+
+def build_synthetic_catalog(path, rows, seed=0, chunk_size=500000):
+    """Write a catalog of random tracks, for tests and benchmarks"""
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz', dtype='S1')
+    with CatalogWriter(path) as writer:
+        for start in range(0, rows, chunk_size):
+            count = min(chunk_size, rows - start)
+            ids = alphabet[rng.integers(0, len(alphabet), size=(count, 22))].view('S22').ravel()
+            features = {name: rng.random(count, dtype=np.float32) for name in FEATURES}
+            features['tempo'] = rng.normal(118, 28, count).clip(40, 220).astype(np.float32)
+            features['speechiness'] *= 0.5
+            numbers = range(start, start + count)
+            writer.append(
+                ids,
+                features,
+                [f'Synthetic Track {n}' for n in numbers],
+                [(f'Artist {n % 50000}',) for n in numbers],
+                [f'https://i.scdn.co/image/synthetic{n % 100000:06d}' for n in numbers]
+            )
+        return writer.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a local track catalog for the local_catalog tier')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='build from a CSV or JSON-lines export')
+    build.add_argument('source')
+    build.add_argument('output')
+    synthetic = commands.add_parser('synthetic', help='build a catalog of random tracks')
+    synthetic.add_argument('output')
+    synthetic.add_argument('--rows', type=int, default=1000000)
+    synthetic.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        rows = build_catalog(args.source, args.output)
+    else:
+        rows = build_synthetic_catalog(args.output, args.rows, args.seed)
+    print(f"Wrote {rows} tracks to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Per-endpoint circuit breakers for Spotify API calls.
+
+Each upstream operation (recommendations, featured playlists, ...) has its
+own breaker. When too many recent calls to an operation failed, the breaker
+opens and further calls fail at once with CircuitOpenError instead of
+waiting on a dead endpoint. After CIRCUIT_OPEN_SECONDS one probe call is let
+through (half-open): if it succeeds the breaker closes, otherwise it stays
+open for another period.
+"""
+import collections
+import contextlib
+import os
+import re
+import threading
+import time
+
+CIRCUIT_BREAKER = os.getenv('CIRCUIT_BREAKER', '1') == '1'
+CIRCUIT_ERROR_RATE = float(os.getenv('CIRCUIT_ERROR_RATE', 0.5))  # Share of failed calls that opens a breaker
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', 10))  # Calls needed in the window before judging
+CIRCUIT_WINDOW = int(os.getenv('CIRCUIT_WINDOW', 20))  # Most recent calls the error rate is taken over
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# (operation, pattern matched against the API path) for the endpoints the
+# recommendation tiers use
+OPERATIONS = [
+    ('genre_seeds', re.compile(r'(?:^|/)recommendations/available-genre-seeds$')),
+    ('recommendations', re.compile(r'(?:^|/)recommendations$')),
+    ('top_tracks', re.compile(r'(?:^|/)me/top/tracks$')),
+    ('featured_playlists', re.compile(r'(?:^|/)browse/featured-playlists$')),
+    ('playlist_tracks', re.compile(r'(?:^|/)playlists/[^/]+/tracks$')),
+    ('new_releases', re.compile(r'(?:^|/)browse/new-releases$')),
+    ('album_tracks', re.compile(r'(?:^|/)albums/[^/]+/tracks$')),
+    ('audio_features', re.compile(r'(?:^|/)audio-features$')),
+]
+
+RETRIED_SERVER_ERROR = re.compile(r'too many 5\d\d error responses')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an operation whose breaker is open"""
+
+    outcome = 'circuit_open'
+
+    def __init__(self, operation, retry_in):
+        super().__init__(f"Spotify {operation} circuit is open (next probe in {retry_in:.0f}s)")
+        self.operation = operation
+        self.retry_in = retry_in
+
+
+def operation_for(url):
+    """Name of the operation a Spotify API URL belongs to, or None"""
+    path = url.split('?', 1)[0].rstrip('/')
+    for operation, pattern in OPERATIONS:
+        if pattern.search(path):
+            return operation
+    return None
+
+
+def counts_as_failure(error):
+    """Whether an error says the endpoint itself is unhealthy.
+
+    Network errors, timeouts, 5xx and 404 (a removed endpoint) count; errors
+    about the user or the request (401, 403, 400) and rate limiting do not.
+    """
+    status = getattr(error, 'http_status', None)
+    if status is None:
+        return True
+    if status == 429:
+        # spotipy reports every exhausted retry as a 429; the reason tells which status it was
+        return bool(RETRIED_SERVER_ERROR.search(str(getattr(error, 'reason', None) or '')))
+    return status == 404 or status >= 500
+
+
+class CircuitBreaker:
+    def __init__(self, name, error_rate=CIRCUIT_ERROR_RATE, min_calls=CIRCUIT_MIN_CALLS,
+                 window=CIRCUIT_WINDOW, open_seconds=CIRCUIT_OPEN_SECONDS, clock=time.monotonic):
+        self.name = name
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.times_opened = 0
+        self.rejected = 0
+        self._outcomes = collections.deque(maxlen=window)  # True for each failed call
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _retry_in(self):
+        return max(0.0, self._opened_at + self.open_seconds - self.clock())
+
+    def allows(self):
+        """Whether a call would be let through right now (without taking the probe)"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            return not self._probing and self._retry_in() == 0
+
+    def before_call(self):
+        """Let a call through (returns True if it is the half-open probe) or raise CircuitOpenError"""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            if self._probing or self._retry_in() > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self._retry_in())
+            self.state = HALF_OPEN
+            self._probing = True
+            return True
+
+    def record(self, failed, probe=False):
+        """Record the outcome of a call that before_call() let through"""
+        with self._lock:
+            if probe:
+                self._probing = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self.state != CLOSED:
+                return  # A call started before the breaker opened
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and failures >= self.error_rate * len(self._outcomes):
+                self._open()
+
+    def abandon_probe(self):
+        """The probe ended without an answer (e.g. it was cancelled); let another call probe"""
+        with self._lock:
+            self._probing = False
+
+    def _open(self):
+        self.state = OPEN
+        self.times_opened += 1
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'state': self.state,
+                'recent_calls': len(self._outcomes),
+                'recent_failures': sum(self._outcomes),
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+            }
+            if self.state != CLOSED:
+                stats['next_probe_in'] = round(self._retry_in(), 1)
+            return stats
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(operation):
+    with _breakers_lock:
+        breaker = _breakers.get(operation)
+        if breaker is None:
+            breaker = _breakers[operation] = CircuitBreaker(operation)
+        return breaker
+
+
+@contextlib.contextmanager
+def guarded(operation):
+    """Run a Spotify call under the operation's breaker (see operation_for()).
+
+    Raises CircuitOpenError instead of entering the block when the breaker
+    is open; calls outside the known operations (None) run unguarded.
+    """
+    if operation is None or not CIRCUIT_BREAKER:
+        yield
+        return
+    breaker = get_breaker(operation)
+    probe = breaker.before_call()
+    try:
+        yield
+    except Exception as e:
+        breaker.record(counts_as_failure(e), probe)
+        raise
+    except BaseException:
+        if probe:
+            breaker.abandon_probe()
+        raise
+    else:
+        breaker.record(False, probe)
+
+
+def open_operation(operations):
+    """The first of operations whose breaker would reject a call right now, or None"""
+    if not CIRCUIT_BREAKER:
+        return None
+    for operation in operations:
+        if not get_breaker(operation).allows():
+            return operation
+    return None
+
+
+def check_operations(operations):
+    """Raise CircuitOpenError when one of operations' breakers would reject a call right now.
+
+    Lets a stage that needs several operations give up before it spends
+    calls on the first ones.
+    """
+    operation = open_operation(operations)
+    if operation is not None:
+        raise CircuitOpenError(operation, get_breaker(operation)._retry_in())
+
+
+def circuit_stats():
+    """State of every breaker that has seen a call, for /health"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
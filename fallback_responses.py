@@ -0,0 +1,60 @@
+"""Pre-serialized /analyze_mood bodies for the hardcoded backup tracks.
+
+Backup tracks are served most when Spotify is degraded, so everything but
+the mood text is encoded (and gzipped) once. The static part of the body
+goes first and the mood text is appended per request; in the gzip variant
+it is appended as a stored (uncompressed) deflate block, so no compression
+work happens per request.
+"""
+import json
+import struct
+import zlib
+
+# Fixed gzip header: no file name or mtime, unknown OS (as gzip.compress(mtime=0) writes)
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+STORED_BLOCK_MAX = 0xffff
+
+
+def stored_blocks(data):
+    """Encode data as stored deflate blocks, the last one marked final"""
+    blocks = []
+    for start in range(0, len(data), STORED_BLOCK_MAX):
+        chunk = data[start:start + STORED_BLOCK_MAX]
+        final = start + STORED_BLOCK_MAX >= len(data)
+        blocks.append(struct.pack('<BHH', 1 if final else 0, len(chunk), len(chunk) ^ 0xffff) + chunk)
+    return b''.join(blocks)
+
+
+class FallbackResponse:
+    """The response body for one backup track list and source, minus the mood text"""
+
+    def __init__(self, tracks, source):
+        static = json.dumps(
+            {'recommendations': [track.to_dict() for track in tracks], 'source': source},
+            separators=(',', ':')
+        ).encode('utf-8')
+        self.prefix = static[:-1] + b',"mood_analysis":'
+        self.prefix_crc = zlib.crc32(self.prefix)
+        # Ends on a byte boundary without a final block, so more blocks can follow
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.gzip_prefix = GZIP_HEADER + compressor.compress(self.prefix) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def _tail(self, mood_analysis):
+        return json.dumps(mood_analysis).encode('utf-8') + b'}'
+
+    def body(self, mood_analysis):
+        return self.prefix + self._tail(mood_analysis)
+
+    def gzip_body(self, mood_analysis):
+        tail = self._tail(mood_analysis)
+        trailer = struct.pack('<II', zlib.crc32(tail, self.prefix_crc), (len(self.prefix) + len(tail)) & 0xffffffff)
+        return self.gzip_prefix + stored_blocks(tail) + trailer
+
+
+def build_fallback_responses(backup_tracks_by_mood):
+    """{(mood, source): FallbackResponse} for the fallback_<mood> and error_fallback_<mood> sources"""
+    responses = {}
+    for mood, tracks in backup_tracks_by_mood.items():
+        for source in (f'fallback_{mood}', f'error_fallback_{mood}'):
+            responses[mood, source] = FallbackResponse(tracks, source)
+    return responses
@@ -0,0 +1,139 @@
+"""Logging for the app's 'moosic' loggers.
+
+Request threads only put records on a queue; a listener thread formats them
+and does the console and file I/O. Messages use lazy %-style arguments, so
+a debug line costs almost nothing unless LOG_LEVEL=DEBUG, and the verbose
+per-attempt lines of the recommendation tiers can be sampled.
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_ASYNC = os.getenv('LOG_ASYNC', '1') == '1'  # Write logs from a listener thread
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # Records waiting to be written before new ones are dropped
+LOG_ATTEMPT_SAMPLE_RATE = float(os.getenv('LOG_ATTEMPT_SAMPLE_RATE', 0.1))  # Share of per-attempt debug lines kept
+
+# Per-attempt debug lines (one per Spotify call a tier makes) go to this logger
+ATTEMPTS_LOGGER = 'moosic.recommendations.attempts'
+
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+
+# Bearer tokens and raw token values (long base64-ish runs), in one pass
+_SENSITIVE = re.compile(r'Bearer [A-Za-z0-9_-]+|[A-Za-z0-9_-]{50,}')
+
+
+def _redact(match):
+    return 'Bearer [REDACTED]' if match.group().startswith('Bearer ') else '[REDACTED]'
+
+
+class SensitiveDataFilter(logging.Filter):
+    """Redacts Spotify tokens from the formatted message, arguments included"""
+
+    def filter(self, record):
+        message = record.getMessage()
+        redacted = _SENSITIVE.sub(_redact, message)
+        if redacted != message:
+            record.msg = redacted
+            record.args = None
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Keeps about rate of the records below WARNING; warnings and errors always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """Hands records to a listener thread that writes them with the given handlers.
+
+    The listener is started on first use in each process, so it also works
+    in workers forked after the app was imported. When the listener falls
+    behind, new records are dropped (and counted) instead of blocking.
+    """
+
+    def __init__(self, handlers, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.target_handlers = handlers
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start_listener(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A queue inherited over fork may hold a lock taken in the parent
+            self.queue = queue.Queue(self.maxsize)
+            self._listener = QueueListener(self.queue, *self.target_handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Merge the arguments now, since they may change once we return, but
+        # leave formatting (timestamps, tracebacks) to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Write out what is still queued"""
+        with self._start_lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+                self._listener = None
+                self._pid = None
+
+
+def configure_logging(log_file_path=None):
+    """Set up the 'moosic' logger: console at INFO, plus a redacted log file if it can be created"""
+    logger = logging.getLogger('moosic')
+    logger.setLevel(LOG_LEVEL)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [console_handler]
+
+    # File handler with sensitive data filtering (falls back to console-only on read-only FS)
+    if log_file_path:
+        try:
+            file_handler = logging.FileHandler(log_file_path)
+            file_handler.setLevel(logging.DEBUG)
+            file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            file_handler.addFilter(SensitiveDataFilter())
+            handlers.append(file_handler)
+        except OSError:
+            logger.warning("Unable to create log file at %s; continuing with console logs only", log_file_path)
+
+    if LOG_ASYNC:
+        queue_handler = BackgroundQueueHandler(handlers)
+        logger.addHandler(queue_handler)
+        atexit.register(queue_handler.stop)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+    logging.getLogger(ATTEMPTS_LOGGER).addFilter(SampleFilter(LOG_ATTEMPT_SAMPLE_RATE))
+    return logger
@@ -0,0 +1,250 @@
+"""In-process latency histograms and counters, rendered in Prometheus text format.
+
+Tiers and upstream Spotify calls record timing spans here; /metrics serves
+the totals. Each process keeps its own numbers (Prometheus adds them up
+across workers). Recording a span is a dict lookup and a few additions
+under a lock, so it is cheap enough for every call.
+"""
+import bisect
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+from circuit_breaker import circuit_stats
+
+METRICS = os.getenv('METRICS', '1') == '1'
+
+# Seconds; spans from a cache hit up to a Spotify call that times out
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labelvalues, value in values:
+            lines.append(f'{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            series = [(labelvalues, list(counts)) for labelvalues, counts in self._series.items()]
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labelvalues, counts in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                labels = _labels(self.labelnames, labelvalues, [('le', _number(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {_number(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """A gauge whose values are read from a function when metrics are rendered"""
+
+    def __init__(self, name, documentation, labelnames, read):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.read = read  # returns {label values: value}
+        _registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for labelvalues, value in self.read().items():
+            lines.append(f'{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}')
+        return lines
+
+
+tier_duration = Histogram(
+    'moosic_tier_duration_seconds',
+    'Time spent in each recommendation tier, by outcome',
+    ('source', 'mood_category', 'outcome')
+)
+tiers_skipped = Counter(
+    'moosic_tier_skipped_total',
+    'Tiers that failed because a Spotify endpoint they called has an open circuit',
+    ('source', 'mood_category')
+)
+recommendation_duration = Histogram(
+    'moosic_recommendation_duration_seconds',
+    'Time to pick recommendations for one mood, by the source that served them',
+    ('source', 'mood_category')
+)
+upstream_duration = Histogram(
+    'moosic_upstream_request_duration_seconds',
+    'Spotify API calls (including retries) by operation and final status',
+    ('operation', 'status')
+)
+stage_output = Counter(
+    'moosic_stage_output_total',
+    'Candidates each recommendation stage gathered and tracks it returned',
+    ('source', 'kind')
+)
+stage_calls = Counter(
+    'moosic_stage_upstream_calls_total',
+    'Spotify calls made by each recommendation stage, by operation',
+    ('source', 'operation')
+)
+rate_limit_wait = Counter(
+    'moosic_rate_limit_wait_seconds_total',
+    'Time Spotify calls spent waiting for the client-side rate limiter, by call priority',
+    ('priority',)
+)
+rate_limit_calls = Counter(
+    'moosic_rate_limit_delayed_total',
+    'Spotify calls held back by the client-side rate limiter, by priority and whether they went ahead or gave up',
+    ('priority', 'outcome')
+)
+rate_limit_responses = Counter(
+    'moosic_rate_limit_responses_total',
+    '429 rate limit responses from Spotify by operation',
+    ('operation',)
+)
+Gauge(
+    'moosic_circuit_open',
+    '1 while the circuit breaker for a Spotify operation is open or half-open',
+    ('operation',),
+    lambda: {(operation, ): int(stats['state'] != 'closed') for operation, stats in circuit_stats().items()}
+)
+
+
+# Source of the tier whose Spotify calls are being made, for stage_calls
+_current_tier = contextvars.ContextVar('recommendation_tier', default=None)
+
+
+def outcome_of(error):
+    """Label for how a span ended; exceptions can name their own with an 'outcome' attribute"""
+    return getattr(error, 'outcome', 'error')
+
+
+def status_of(error):
+    """Status label for a failed upstream call: the HTTP status or 'network_error'"""
+    status = getattr(error, 'http_status', None)
+    return str(status) if status is not None else 'network_error'
+
+
+@contextlib.contextmanager
+def tier_span(source, mood_category):
+    """Time one tier run; Spotify calls made inside it are counted against the tier"""
+    if not METRICS:
+        yield
+        return
+    token = _current_tier.set(source)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        tier_duration.observe(time.perf_counter() - started, source, mood_category, outcome_of(e))
+        raise
+    else:
+        tier_duration.observe(time.perf_counter() - started, source, mood_category, 'success')
+    finally:
+        _current_tier.reset(token)
+
+
+@contextlib.contextmanager
+def upstream_span(operation):
+    """Time one Spotify API call; calls outside the known operations are labelled 'other'"""
+    if not METRICS:
+        yield
+        return
+    tier = _current_tier.get()
+    if tier is not None:
+        stage_calls.inc(tier, operation or 'other')
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        upstream_duration.observe(time.perf_counter() - started, operation or 'other', status_of(e))
+        raise
+    upstream_duration.observe(time.perf_counter() - started, operation or 'other', 'ok')
+
+
+def record_recommendation(source, mood_category, started):
+    """Record how long picking recommendations took, given its perf_counter() start"""
+    if METRICS:
+        recommendation_duration.observe(time.perf_counter() - started, source, mood_category)
+
+
+def record_stage_output(source, candidates, tracks):
+    """Record what a stage produced: candidates gathered and tracks returned"""
+    if METRICS:
+        stage_output.inc(source, 'candidates', amount=candidates)
+        stage_output.inc(source, 'tracks', amount=tracks)
+
+
+def record_throttle(priority, waited, outcome):
+    """Record a call the rate limiter held back: outcome is 'waited' or 'rejected'"""
+    if METRICS:
+        rate_limit_wait.inc(priority, amount=waited)
+        rate_limit_calls.inc(priority, outcome)
+
+
+def record_rate_limited(operation):
+    if METRICS:
+        rate_limit_responses.inc(operation or 'other')
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,160 @@
+import random
+import re
+
+# Mood keywords and their corresponding analysis and genres
+# Map our moods to valid Spotify genres
+MOOD_MAP = {
+    'happy': {
+        'analysis': 'You seem happy and upbeat! Your mood is positive and energetic.',
+        'genre': 'happy',
+        'mood_category': 'happy'
+    },
+    'sad': {
+        'analysis': 'You seem to be feeling down or melancholic. Music can help lift your spirits.',
+        'genre': 'sad',
+        'mood_category': 'sad'
+    },
+    'angry': {
+        'analysis': 'Your text suggests feelings of frustration or anger. Some energizing music might help.',
+        'genre': 'rock',
+        'mood_category': 'angry'
+    },
+    'tired': {
+        'analysis': 'You sound tired or fatigued. Some relaxing music could be just what you need.',
+        'genre': 'chill',
+        'mood_category': 'relaxed'
+    },
+    'excited': {
+        'analysis': 'You seem very excited and enthusiastic! Some upbeat music would match your energy.',
+        'genre': 'dance',
+        'mood_category': 'energetic'
+    },
+    'relaxed': {
+        'analysis': 'You appear to be in a calm, relaxed state. Some smooth music would complement this well.',
+        'genre': 'ambient',
+        'mood_category': 'relaxed'
+    },
+    'stressed': {
+        'analysis': 'You seem to be experiencing stress. Some calming music might help you unwind.',
+        'genre': 'classical',
+        'mood_category': 'relaxed'
+    },
+    'bored': {
+        'analysis': 'You sound a bit bored or understimulated. Some engaging music could help.',
+        'genre': 'pop',
+        'mood_category': 'energetic'
+    },
+    'nostalgic': {
+        'analysis': 'Your words have a nostalgic quality. Music that reminds you of good times might resonate.',
+        'genre': 'rock-n-roll',
+        'mood_category': 'nostalgic'
+    },
+    'focused': {
+        'analysis': 'You seem to be in a focused state. Some concentration-enhancing music could help maintain this.',
+        'genre': 'study',
+        'mood_category': 'focused'
+    },
+    'sleepy': {
+        'analysis': 'You sound sleepy or drowsy. Some gentle music could help you relax further.',
+        'genre': 'sleep',
+        'mood_category': 'relaxed'
+    },
+    'energetic': {
+        'analysis': 'Your text suggests high energy levels. Some upbeat music would match this well.',
+        'genre': 'work-out',
+        'mood_category': 'energetic'
+    },
+    'calm': {
+        'analysis': 'You seem calm and collected. Some gentle music would complement this mood.',
+        'genre': 'chill',
+        'mood_category': 'relaxed'
+    },
+    'anxious': {
+        'analysis': 'Your text suggests some anxiety or worry. Some calming music might help you relax.',
+        'genre': 'ambient',
+        'mood_category': 'relaxed'
+    },
+    'love': {
+        'analysis': 'Your words suggest feelings of love or romance. Some heartfelt music would match this mood.',
+        'genre': 'romance',
+        'mood_category': 'happy'
+    }
+}
+
+# Common phrases used to infer a mood when no mood keyword is present
+MOOD_PHRASES = {
+    'happy': ["feeling good", "great day", "wonderful", "amazing"],
+    'sad': ["feeling down", "not great", "terrible", "worst"],
+    'focused': ["need to focus", "concentrate", "study"],
+    'relaxed': ["can't sleep", "need to relax", "wind down"],
+    'energetic': ["need energy", "workout", "exercise"],
+}
+
+# Moods to pick from when nothing in the text gives us a hint
+SAFE_MOODS = ["happy", "relaxed", "energetic", "focused"]
+
+DEFAULT_ANALYSIS = 'I analyzed your text and will recommend some music that might match your current state.'
+
+
+def _alternation(words):
+    # Longest first so a shorter word never shadows a longer one
+    return '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+_PHRASE_TO_MOOD = {phrase: mood for mood, phrases in MOOD_PHRASES.items() for phrase in phrases}
+
+# One pattern for every keyword and phrase. Keywords are matched as whole
+# words (like the old per-keyword \b searches). Phrases are plain substrings
+# and sit in a zero-width lookahead so they never consume text a keyword
+# might need, e.g. "need to relax" inside "need to relaxed".
+MOOD_PATTERN = re.compile(
+    r'\b(?P<keyword>' + _alternation(MOOD_MAP) + r')\b'
+    r'|(?=(?P<phrase>' + _alternation(_PHRASE_TO_MOOD) + r'))'
+)
+
+
+def score_moods(text):
+    """Score every mood mentioned in text in a single pass.
+
+    Returns a list of (mood, score) pairs, best first. Keyword hits always
+    win over phrase hits; ties are broken by the earliest match in the text,
+    so the result never depends on dict order.
+    """
+    text = text.lower()
+    keyword_hits = {}
+    phrase_hits = {}
+    for match in MOOD_PATTERN.finditer(text):
+        keyword = match.group('keyword')
+        if keyword:
+            hits = keyword_hits
+            mood = keyword
+        else:
+            hits = phrase_hits
+            mood = _PHRASE_TO_MOOD[match.group('phrase')]
+        if mood in hits:
+            hits[mood][0] += 1
+        else:
+            hits[mood] = [1, match.start()]
+
+    # Phrases are only a fallback when no mood keyword was used
+    hits = keyword_hits or phrase_hits
+    ranked = sorted(hits.items(), key=lambda item: (-item[1][0], item[1][1]))
+    return [(mood, count) for mood, (count, _) in ranked]
+
+
+# Define a simple mood analyzer function
+def analyze_mood_text(text):
+    """Simple rule-based mood analyzer as a fallback for the Gemini API"""
+    scored = score_moods(text)
+    if not scored:
+        # Default if no mood is detected - pick from a few safe genres
+        selected = random.choice(SAFE_MOODS)
+        return {
+            'analysis': DEFAULT_ANALYSIS,
+            'genre': MOOD_MAP[selected]['genre'],
+            'mood_category': MOOD_MAP[selected]['mood_category']
+        }
+
+    # Use the best scoring mood
+    chosen_mood = scored[0][0]
+    return dict(MOOD_MAP[chosen_mood])
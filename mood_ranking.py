@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+from catalog import DEFAULT_RANGE, FEATURE_RANGES, FEATURES, mood_targets
+from ttl_cache import MemoryBackend, TTLCache
+
+# Spotify's audio-features endpoint takes up to 100 track ids per call
+AUDIO_FEATURES_BATCH = 100
+
+# A track's audio features never change, so keep them for a long time. Only
+# the feature values are kept, as a tuple in FEATURES order (None when
+# Spotify has no features for the track).
+audio_feature_cache = TTLCache(
+    backend=MemoryBackend(max_entries=int(os.getenv('AUDIO_FEATURE_CACHE_ENTRIES', 100000))),
+    ttl=int(os.getenv('AUDIO_FEATURE_CACHE_TTL', 7 * 24 * 3600)),
+    stale_ttl=0
+)
+
+# How much worse being outside a min_/max_ bound is than being the same
+# distance away from a target
+BOUND_WEIGHT = 4.0
+
+_LOW = np.array([FEATURE_RANGES.get(f, DEFAULT_RANGE)[0] for f in FEATURES], dtype=np.float32)
+_SPAN = np.array([FEATURE_RANGES.get(f, DEFAULT_RANGE)[1] for f in FEATURES], dtype=np.float32) - _LOW
+
+
+def cached_features(track_ids):
+    """Return ({track_id: feature tuple or None}, [ids that still need fetching])"""
+    found = {}
+    missing = []
+    for track_id in dict.fromkeys(track_ids):
+        cached = audio_feature_cache.peek(track_id)
+        if cached is None:
+            missing.append(track_id)
+        else:
+            found[track_id] = cached[0]
+    return found, missing
+
+
+def feature_batches(track_ids):
+    """Split ids into chunks of at most AUDIO_FEATURES_BATCH"""
+    return [track_ids[i:i + AUDIO_FEATURES_BATCH] for i in range(0, len(track_ids), AUDIO_FEATURES_BATCH)]
+
+
+def remember_features(track_ids, response, found):
+    """Cache one audio-features response (a list aligned with track_ids) and add it to found"""
+    for track_id, features in zip(track_ids, response or []):
+        vector = None
+        if features and all(features.get(name) is not None for name in FEATURES):
+            vector = tuple(float(features[name]) for name in FEATURES)
+        found[track_id] = audio_feature_cache.set(track_id, vector)
+
+
+def rank_tracks(tracks, features_by_id, mood_features, count):
+    """Return the count tracks that best fit mood_features, best first.
+
+    Every candidate is scored in one pass over a (tracks x features)
+    matrix: squared, range-scaled distance to the mood's targets plus a
+    weighted penalty for each min_/max_ bound it falls outside. Tracks
+    without features go last, in their original order.
+    """
+    if not tracks:
+        return []
+    matrix = np.full((len(tracks), len(FEATURES)), np.nan, dtype=np.float32)
+    for row, track in enumerate(tracks):
+        vector = features_by_id.get(track.id)
+        if vector is not None:
+            matrix[row] = vector
+    scaled = (matrix - _LOW) / _SPAN
+
+    lower = np.full(len(FEATURES), -np.inf, dtype=np.float32)
+    upper = np.full(len(FEATURES), np.inf, dtype=np.float32)
+    target = np.full(len(FEATURES), np.nan, dtype=np.float32)
+    for index, feature in enumerate(FEATURES):
+        if f'min_{feature}' in mood_features:
+            lower[index] = mood_features[f'min_{feature}']
+        if f'max_{feature}' in mood_features:
+            upper[index] = mood_features[f'max_{feature}']
+    for feature, value in mood_targets(mood_features).items():
+        target[FEATURES.index(feature)] = value
+    lower = (lower - _LOW) / _SPAN
+    upper = (upper - _LOW) / _SPAN
+    target = (target - _LOW) / _SPAN
+
+    has_target = ~np.isnan(target)
+    distance = np.square(scaled[:, has_target] - target[has_target]).sum(axis=1)
+    violation = np.clip(lower - scaled, 0, None) + np.clip(scaled - upper, 0, None)
+    score = distance + BOUND_WEIGHT * np.square(violation).sum(axis=1)
+    score[np.isnan(score)] = np.inf
+    order = np.argsort(score, kind='stable')[:count]
+    return [tracks[row] for row in order]
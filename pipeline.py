@@ -0,0 +1,148 @@
+"""The recommendation tiers as a pipeline of configured stages.
+
+Each tier is registered as a Stage: its source name, the Spotify operations
+it needs, a time budget, how many candidates it gathers before it stops
+calling Spotify (its early exit) and the per-call sizes that decide what it
+costs in API calls. The defaults are set where the tiers are defined;
+PIPELINE_CONFIG names a JSON file that overrides them without code changes:
+
+    {
+        "stages": {
+            "spotify_featured_playlist": {"budget": 1.5, "playlists": 3},
+            "spotify_new_releases": {"enabled": false}
+        },
+        "moods": {"focused": ["local_catalog", "spotify_advanced", "spotify_simple"]}
+    }
+
+"moods" gives a mood category its own stage order. The ordered stage list
+for every mood is built once at import, so a request only looks it up.
+"""
+import copy
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('moosic.pipeline')
+
+PIPELINE_CONFIG = os.getenv('PIPELINE_CONFIG')  # Path of a JSON file with stage settings
+
+# Settings every stage has; any others are the stage's own call sizes
+STAGE_SETTINGS = ('enabled', 'budget', 'target')
+
+
+class StageOverBudget(Exception):
+    """Raised by a stage whose time budget ran out before it found any tracks"""
+
+    outcome = 'over_budget'
+
+
+class Stage:
+    """One recommendation tier and its settings.
+
+    run(ctx, stage) is called with a started copy of the stage (see start()),
+    so it can read its settings as attributes and check its budget.
+    """
+
+    def __init__(self, source, name, run, operations=(), budget=None, target=None,
+                 needs_mood_features=False, **limits):
+        self.source = source
+        self.name = name
+        self.run = run
+        # Spotify operations the stage calls when it has no cached answer (see tier_priorities)
+        self.operations = tuple(operations)
+        self.enabled = True
+        self.budget = budget  # Seconds; None for no limit
+        self.target = target  # Candidates to gather before calling Spotify no more
+        self.needs_mood_features = needs_mood_features
+        self.limits = tuple(limits)
+        self.__dict__.update(limits)
+        # Set on a started copy: when its budget runs out, and how many candidates it gathered
+        self.deadline = None
+        self.gathered = 0
+
+    def __repr__(self):
+        return f'Stage({self.source!r})'
+
+    def configure(self, settings):
+        """Apply overrides from the config, refusing settings the stage doesn't have"""
+        unknown = set(settings) - set(STAGE_SETTINGS) - set(self.limits)
+        if unknown:
+            raise ValueError(f"Unknown settings for pipeline stage {self.source}: {', '.join(sorted(unknown))}")
+        for key, value in settings.items():
+            setattr(self, key, value)
+
+    def bound(self, run):
+        """The same stage with another function (the async engine's coroutine)"""
+        stage = copy.copy(self)
+        stage.run = run
+        return stage
+
+    def start(self):
+        """A copy for one run of the stage, whose budget starts now"""
+        stage = copy.copy(self)
+        if self.budget is not None:
+            stage.deadline = time.monotonic() + self.budget
+        return stage
+
+    def remaining(self):
+        """Seconds left of a started stage's budget, or None without one"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def over_budget(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def no_tracks(self, message):
+        """The exception for a stage that ends without tracks"""
+        if self.over_budget():
+            return StageOverBudget(f"{self.name} ran out of its {self.budget}s budget")
+        return Exception(message)
+
+
+def load_config(path=PIPELINE_CONFIG):
+    """The parsed PIPELINE_CONFIG file, or an empty config without one"""
+    if not path:
+        return {}
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - {'stages', 'moods'}
+    if unknown:
+        raise ValueError(f"Unknown sections in {path}: {', '.join(sorted(unknown))}")
+    return config
+
+
+def configure_stages(stages, config):
+    """Apply the config's per-stage settings to stages, in place"""
+    by_source = {stage.source: stage for stage in stages}
+    for source, settings in config.get('stages', {}).items():
+        if source not in by_source:
+            # Stages such as local_catalog are only registered when they are set up
+            logger.warning("Pipeline config names unknown stage %s", source)
+            continue
+        by_source[source].configure(settings)
+
+
+def build_pipelines(stages, mood_categories, config):
+    """{mood category: ordered enabled stages}, plus None for any other mood"""
+    by_source = {stage.source: stage for stage in stages}
+    orders = config.get('moods', {})
+    for mood_category, order in orders.items():
+        unknown = [source for source in order if source not in by_source]
+        if unknown:
+            logger.warning("Pipeline config for %s names unknown stages: %s", mood_category, ', '.join(unknown))
+
+    def pipeline(mood_category, has_features):
+        order = orders.get(mood_category)
+        chosen = stages if order is None else [by_source[source] for source in order if source in by_source]
+        return [
+            stage for stage in chosen
+            if stage.enabled and (has_features or not stage.needs_mood_features)
+        ]
+
+    pipelines = {mood_category: pipeline(mood_category, True) for mood_category in mood_categories}
+    pipelines[None] = pipeline(None, False)
+    for mood_category, stages_for_mood in pipelines.items():
+        logger.debug("Pipeline for %s: %s", mood_category or 'other moods', ', '.join(s.source for s in stages_for_mood))
+    return pipelines
@@ -0,0 +1,279 @@
+"""Client-side rate limiting for Spotify API calls.
+
+Spotify limits each app (client id) over a rolling window and answers with
+429 and a Retry-After header once the app goes over. Every call takes a
+token from a bucket kept per client id in a small memory-mapped file, so all
+worker processes on the host draw on the same budget, and a 429 pauses the
+bucket for all of them until Retry-After has passed.
+
+Calls have a priority. Speculative calls (hedged tiers that may not be
+needed) only take a token while the bucket holds more than a reserve, so
+when tokens run short the primary tier's calls get them first. A call that
+would have to wait longer than its priority allows fails at once with
+RateLimitedError, and its tier falls through like any other failure.
+"""
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: each process keeps its own bucket
+    fcntl = None
+
+from circuit_breaker import RETRIED_SERVER_ERROR
+from metrics import record_rate_limited, record_throttle
+
+logger = logging.getLogger('moosic.rate_limiter')
+
+RATE_LIMIT = os.getenv('RATE_LIMIT', '1') == '1'
+RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', 25))  # Sustained calls per second for the client id
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 50))  # Calls that may go out at once after a quiet spell
+RATE_LIMIT_RESERVE = float(os.getenv('RATE_LIMIT_RESERVE', 0.25))  # Share of the burst speculative calls leave alone
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 2.0))  # Longest a primary call waits for a token
+RATE_LIMIT_SPECULATIVE_MAX_WAIT = float(os.getenv('RATE_LIMIT_SPECULATIVE_MAX_WAIT', 0.5))
+RATE_LIMIT_DIR = os.getenv('RATE_LIMIT_DIR') or tempfile.gettempdir()
+
+PRIMARY = 'primary'
+SPECULATIVE = 'speculative'
+
+# Shared bucket state: tokens, when they were last counted, paused until (all time.time())
+_STATE = struct.Struct('ddd')
+
+_priority = contextvars.ContextVar('spotify_call_priority', default=PRIMARY)
+
+
+@contextlib.contextmanager
+def call_priority(priority):
+    """Run the block's Spotify calls (in this thread or task) at the given priority"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class RateLimitedError(Exception):
+    """Raised instead of making a call that would wait too long for the rate limit"""
+
+    outcome = 'rate_limited'
+
+    def __init__(self, wait, waited=0.0):
+        # wait is what was still to come when the call gave up, after waiting waited
+        super().__init__(
+            f"Spotify rate limit: gave up after waiting {waited:.2f}s, next call allowed in {wait:.2f}s"
+        )
+        self.wait = wait
+        self.waited = waited
+
+
+def is_throttled(error):
+    """Whether an error is Spotify's 429 for going over the rate limit"""
+    if getattr(error, 'http_status', None) != 429:
+        return False
+    # spotipy also reports exhausted 5xx retries as a 429
+    return not RETRIED_SERVER_ERROR.search(str(getattr(error, 'reason', None) or ''))
+
+
+def retry_after_seconds(headers, default=1.0):
+    """Seconds to wait from a Retry-After header (delta-seconds or an HTTP date)"""
+    value = next((v for k, v in (headers or {}).items() if k.lower() == 'retry-after'), None)
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """A token bucket whose state every process opening the same path shares.
+
+    Without a path (or without fcntl) the state is kept in this process.
+    """
+
+    def __init__(self, path, rate=RATE_LIMIT_PER_SECOND, burst=RATE_LIMIT_BURST):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._local_state = [burst, time.time(), 0.0]
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Locks belong to the open file, which a forked child would share with
+        # its parent, so every process opens the file itself
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < _STATE.size:
+                    os.ftruncate(fd, _STATE.size)  # All zeros: the bucket fills up on first use
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, _STATE.size)
+            self._fd = fd
+        except OSError as e:
+            logger.warning("Rate limit state at %s unavailable, limiting per process: %s", self.path, e)
+            self.path = None
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def _state(self):
+        """The state as a [tokens, updated_at, paused_until] list, locked; changes are written back"""
+        with self._lock:
+            if self.path is not None and fcntl is not None and self._pid != os.getpid():
+                self._open()
+            if self.path is None or fcntl is None:
+                yield self._local_state
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = list(_STATE.unpack_from(self._map))
+                yield state
+                _STATE.pack_into(self._map, 0, *state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def take(self, reserve=0.0):
+        """Take a token if at least reserve would be left; otherwise return the seconds to wait"""
+        now = time.time()
+        with self._state() as state:
+            tokens, updated_at, paused_until = state
+            if now < paused_until:
+                return paused_until - now
+            tokens = min(self.burst, tokens + max(0.0, now - updated_at) * self.rate)
+            if tokens >= 1 + reserve:
+                state[0], state[1] = tokens - 1, now
+                return 0.0
+            state[0], state[1] = tokens, now
+            return (1 + reserve - tokens) / self.rate
+
+    def pause(self, seconds):
+        """Let no calls through for seconds, then start again from an empty bucket"""
+        until = time.time() + seconds
+        with self._state() as state:
+            if until > state[2]:
+                state[0], state[1], state[2] = 0.0, until, until
+
+    def peek(self):
+        """(tokens, seconds still paused) without taking anything"""
+        now = time.time()
+        with self._state() as state:
+            tokens, updated_at, paused_until = state
+        if now < paused_until:
+            return 0.0, paused_until - now
+        return min(self.burst, tokens + max(0.0, now - updated_at) * self.rate), 0.0
+
+
+class RateLimiter:
+    def __init__(self, bucket, reserve=RATE_LIMIT_RESERVE * RATE_LIMIT_BURST,
+                 max_wait=RATE_LIMIT_MAX_WAIT, speculative_max_wait=RATE_LIMIT_SPECULATIVE_MAX_WAIT):
+        self.bucket = bucket
+        self.reserves = {PRIMARY: 0.0, SPECULATIVE: reserve}
+        self.max_waits = {PRIMARY: max_wait, SPECULATIVE: speculative_max_wait}
+        # Counters for this process
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.rejected = 0
+        self.throttled = 0
+        self._stats_lock = threading.Lock()
+
+    def _next_wait(self, priority, waited):
+        """0 once a token was taken, else seconds to sleep; RateLimitedError past the priority's wait limit"""
+        wait = self.bucket.take(self.reserves[priority])
+        if wait and waited + wait > self.max_waits[priority]:
+            self._finish(priority, waited, 'rejected')
+            raise RateLimitedError(wait, waited)
+        return wait
+
+    def _finish(self, priority, waited, outcome):
+        with self._stats_lock:
+            if outcome == 'rejected':
+                self.rejected += 1
+            elif waited:
+                self.waited += 1
+            self.wait_seconds += waited
+        if waited or outcome == 'rejected':
+            record_throttle(priority, waited, outcome)
+
+    def acquire(self):
+        """Wait for a token at the current call priority"""
+        priority = _priority.get()
+        waited = 0.0
+        while True:
+            wait = self._next_wait(priority, waited)
+            if not wait:
+                break
+            time.sleep(wait)
+            waited += wait
+        self._finish(priority, waited, 'waited')
+
+    async def acquire_async(self):
+        """acquire() for coroutines on the async engine's loop"""
+        priority = _priority.get()
+        waited = 0.0
+        while True:
+            wait = self._next_wait(priority, waited)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        self._finish(priority, waited, 'waited')
+
+    def throttled_by_spotify(self, operation, error):
+        """Pause every process's calls for the Retry-After of a 429"""
+        seconds = retry_after_seconds(getattr(error, 'headers', None))
+        logger.warning("Spotify rate limit hit on %s; pausing calls for %.1fs", operation, seconds)
+        self.bucket.pause(seconds)
+        with self._stats_lock:
+            self.throttled += 1
+        record_rate_limited(operation)
+
+    def stats(self):
+        tokens, paused_for = self.bucket.peek()
+        with self._stats_lock:
+            return {
+                'tokens': round(tokens, 1),
+                'paused_for': round(paused_for, 1),
+                'waited': self.waited,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'rejected': self.rejected,
+                'throttled_by_spotify': self.throttled,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(client_id=None):
+    """The rate limiter for a Spotify client id (the app's own by default)"""
+    client_id = client_id or os.getenv('SPOTIFY_CLIENT_ID') or 'default'
+    with _limiters_lock:
+        limiter = _limiters.get(client_id)
+        if limiter is None:
+            name = hashlib.sha256(client_id.encode()).hexdigest()[:16]
+            bucket = TokenBucket(os.path.join(RATE_LIMIT_DIR, f'moosic-rate-limit-{name}'))
+            limiter = _limiters[client_id] = RateLimiter(bucket)
+        return limiter
+
+
+def rate_limit_stats():
+    """Bucket state and counters of the app's limiter, for /health"""
+    return get_limiter().stats() if RATE_LIMIT else None
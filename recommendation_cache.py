@@ -0,0 +1,132 @@
+import json
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+def quantize_features(audio_features):
+    """Round audio feature parameters so near-identical requests share a cache key"""
+    quantized = {}
+    for key, value in audio_features.items():
+        if key.endswith('tempo'):
+            quantized[key] = int(round(value / 10.0) * 10)  # 10 BPM steps
+        elif isinstance(value, float):
+            quantized[key] = round(round(value / 0.05) * 0.05, 2)  # 0.05 steps
+        else:
+            quantized[key] = value
+    return quantized
+
+
+def pool_cache_key(mood_category, audio_features, genres):
+    features = tuple(sorted(quantize_features(audio_features).items()))
+    return (mood_category, features, tuple(sorted(genres)))
+
+
+class PoolCache:
+    """LRU cache of candidate track pools with a TTL and a memory cap in bytes.
+
+    Pools are lists of CompactTrack. The size of a pool is estimated from
+    its JSON encoding when it is stored. Least recently used pools are
+    evicted once the cap is reached.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pools.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            tracks, size, expires_at = entry
+            if now >= expires_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._pools.move_to_end(key)
+            self.hits += 1
+            return tracks
+
+    def put(self, key, tracks):
+        size = len(json.dumps([t.to_dict() for t in tracks]))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._pools:
+                self._remove(key)
+            self._pools[key] = (tracks, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._pools)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._pools.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'pools': len(self._pools),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class RecentlySeen:
+    """Remembers the last few track ids shown to each user"""
+
+    def __init__(self, per_user=60, max_users=10000):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_key):
+        if user_key is None:
+            return frozenset()
+        with self._lock:
+            seen = self._users.get(user_key)
+            return frozenset(seen) if seen else frozenset()
+
+    def add(self, user_key, track_ids):
+        if user_key is None:
+            return
+        with self._lock:
+            seen = self._users.get(user_key)
+            if seen is None:
+                seen = self._users[user_key] = deque(maxlen=self.per_user)
+            self._users.move_to_end(user_key)
+            seen.extend(track_ids)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+
+def sample_pool(pool, count, exclude=frozenset()):
+    """Pick count random tracks from pool, preferring ones not in exclude"""
+    fresh = [t for t in pool if t.id not in exclude]
+    if len(fresh) >= count:
+        return random.sample(fresh, count)
+    # Not enough unseen tracks left, so top up with seen ones
+    seen = [t for t in pool if t.id in exclude]
+    return fresh + random.sample(seen, min(count - len(fresh), len(seen)))
@@ -0,0 +1,1104 @@
+import contextvars
+import copy
+import logging
+import os
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as wait_futures
+
+from circuit_breaker import CircuitOpenError, check_operations, open_operation
+from metrics import record_recommendation, record_stage_output, tier_span, tiers_skipped
+from mood_ranking import cached_features, feature_batches, rank_tracks, remember_features
+from pipeline import Stage, StageOverBudget, build_pipelines, configure_stages, load_config
+from rate_limiter import PRIMARY, SPECULATIVE, RateLimitedError, call_priority
+from recommendation_cache import PoolCache, RecentlySeen, pool_cache_key, sample_pool
+from tracks import CompactTrack, TrackCollector, has_valid_album_art
+from ttl_cache import MemoryBackend, TTLCache, make_backend
+
+logger = logging.getLogger('moosic.recommendations')
+# Verbose lines logged once per Spotify call; these can be sampled (see logging_setup)
+attempt_logger = logging.getLogger('moosic.recommendations.attempts')
+
+# Number of tracks we return for every mood analysis
+TARGET_TRACKS = 12
+
+
+class SpotifyAuthError(Exception):
+    """Raised when Spotify rejects the user's token, so there is no point trying other tiers"""
+
+
+def is_auth_error(error):
+    """Check whether an upstream error means the user's Spotify session is no longer valid"""
+    status = getattr(error, 'http_status', None)
+    if status is not None:
+        # A Spotify response: only a 401 means the token was rejected (a 400
+        # or 429 can still mention "token" in its message)
+        return status == 401
+    message = str(error).lower()
+    return "authentication" in message or "unauthorized" in message or "token" in message
+
+# List of valid Spotify genres we can use for recommendations
+VALID_SPOTIFY_GENRES = frozenset([
+    "acoustic", "afrobeat", "alt-rock", "alternative", "ambient", "anime", 
+    "black-metal", "bluegrass", "blues", "brazil", "breakbeat", "british", 
+    "cantopop", "chicago-house", "children", "chill", "classical", "club", 
+    "comedy", "country", "dance", "dancehall", "death-metal", "deep-house", 
+    "detroit-techno", "disco", "disney", "drum-and-bass", "dub", "dubstep", 
+    "edm", "electro", "electronic", "emo", "folk", "forro", "french", "funk", 
+    "garage", "german", "gospel", "goth", "grindcore", "groove", "grunge", 
+    "guitar", "happy", "hard-rock", "hardcore", "hardstyle", "heavy-metal", 
+    "hip-hop", "house", "idm", "indian", "indie", "indie-pop", "industrial", 
+    "iranian", "j-dance", "j-idol", "j-pop", "j-rock", "jazz", "k-pop", "kids", 
+    "latin", "latino", "malay", "mandopop", "metal", "metalcore", "minimal-techno", 
+    "mpb", "new-age", "opera", "pagode", "party", "piano", "pop", "pop-film", 
+    "power-pop", "progressive-house", "psych-rock", "punk", "punk-rock", "r-n-b", 
+    "reggae", "reggaeton", "rock", "rock-n-roll", "rockabilly", "romance", "sad", 
+    "salsa", "samba", "sertanejo", "show-tunes", "singer-songwriter", "ska", 
+    "sleep", "songwriter", "soul", "spanish", "study", "summer", "swedish", "synth-pop", 
+    "tango", "techno", "trance", "trip-hop", "turkish", "work-out", "world-music"
+])
+
+# Spotify's genre seed list almost never changes, so share one copy across
+# requests instead of fetching it every time
+GENRE_SEEDS_CACHE_KEY = 'recommendation_genre_seeds'
+GENRE_SEEDS_ERROR_TTL = 300  # Retry a failing lookup after 5 minutes
+genre_seed_cache = TTLCache(
+    backend=make_backend(
+        os.getenv('GENRE_CACHE_BACKEND', 'memory'),
+        os.getenv('GENRE_CACHE_PATH')
+    ),
+    ttl=int(os.getenv('GENRE_CACHE_TTL', 24 * 3600)),
+    stale_ttl=int(os.getenv('GENRE_CACHE_STALE_TTL', 7 * 24 * 3600))
+)
+
+def get_genre_seeds(sp):
+    """Return Spotify's available genre seeds as a frozenset, cached process-wide"""
+    def load():
+        available_genres = sp.recommendation_genre_seeds()
+        genres = frozenset(available_genres.get('genres', []))
+        logger.debug("Loaded %s Spotify genre seeds", len(genres))
+        return genres
+
+    try:
+        return genre_seed_cache.get(GENRE_SEEDS_CACHE_KEY, load)
+    except Exception as genre_err:
+        if is_auth_error(genre_err):
+            raise
+        logger.warning("Failed to get genre seeds: %s", genre_err)
+        # Fall back to our own list for a while instead of retrying on every request
+        return genre_seed_cache.set(GENRE_SEEDS_CACHE_KEY, VALID_SPOTIFY_GENRES, ttl=GENRE_SEEDS_ERROR_TTL, stale_ttl=0)
+
+# Audio features for different moods to create more diverse recommendations
+MOOD_FEATURES = {
+    "happy": {
+        "min_valence": 0.7,
+        "min_energy": 0.7,
+        "target_tempo": 120,
+        "genres": ["happy", "pop", "dance", "disco"]
+    },
+    "sad": {
+        "max_valence": 0.4,
+        "max_energy": 0.4, 
+        "target_tempo": 90,
+        "genres": ["sad", "indie", "singer-songwriter", "piano"]
+    },
+    "relaxed": {
+        "max_energy": 0.4,
+        "target_instrumentalness": 0.5,
+        "genres": ["ambient", "chill", "study", "piano"]
+    },
+    "energetic": {
+        "min_energy": 0.8,
+        "min_tempo": 125,
+        "genres": ["work-out", "dance", "edm", "rock"]
+    },
+    "focused": {
+        "target_instrumentalness": 0.7,
+        "max_speechiness": 0.1,
+        "genres": ["study", "classical", "ambient", "piano"]
+    },
+    "angry": {
+        "min_energy": 0.7,
+        "max_valence": 0.4,
+        "target_tempo": 140,
+        "genres": ["rock", "metal", "hard-rock", "alt-rock"]
+    },
+    "nostalgic": {
+        "target_acousticness": 0.6,
+        "genres": ["rock-n-roll", "blues", "jazz", "soul"]
+    }
+}
+
+
+def make_mood_plan(mood_category, genre):
+    """Return (audio_features, genres) tier 1 asks Spotify for, before genre seeds are checked"""
+    # Get audio features for this mood if available
+    audio_features = {}
+    if mood_category in MOOD_FEATURES:
+        audio_features = MOOD_FEATURES[mood_category].copy()
+        # Remove the genres key to use separately
+        genres = audio_features.pop('genres', [genre])
+    else:
+        genres = [genre]
+
+    for g in genres:
+        if g not in VALID_SPOTIFY_GENRES:
+            logger.warning("Genre '%s' for mood %s is not a Spotify genre seed", g, mood_category)
+    # Ensure we're using valid genres (take up to 2)
+    valid_genres = [g for g in genres if g in VALID_SPOTIFY_GENRES][:2]
+    if not valid_genres:
+        valid_genres = ["pop"]  # Default fallback
+    return audio_features, valid_genres
+
+
+# Worked out once per mood; moods without features get a plan from their genre per request
+MOOD_PLANS = {mood_category: make_mood_plan(mood_category, None) for mood_category in MOOD_FEATURES}
+
+# Hardcoded backup tracks by mood (as a last resort)
+BACKUP_TRACKS_BY_MOOD = {
+    "happy": [
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2736acc3a55cbab6f9ae5505aa4"}]},
+            "artists": [{"name": "Taylor Swift"}],
+            "name": "Shake It Off",
+            "external_urls": {"spotify": "https://open.spotify.com/track/0cqRj7pUJDkTCEsJkx8snD"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273ba5db46f4b838ef6027e6f96"}]},
+            "artists": [{"name": "Ed Sheeran"}],
+            "name": "Shape of You",
+            "external_urls": {"spotify": "https://open.spotify.com/track/7qiZfU4dY1lWllzX7mPBI3"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273c5148520a59be191eea29985"}]},
+            "artists": [{"name": "Pharrell Williams"}],
+            "name": "Happy",
+            "external_urls": {"spotify": "https://open.spotify.com/track/60nZcImufyMA1MKQY3dcCO"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2739e1cfc756886ac782e363d79"}]},
+            "artists": [{"name": "Justin Timberlake"}],
+            "name": "Can't Stop The Feeling!",
+            "external_urls": {"spotify": "https://open.spotify.com/track/1WkMMavIMc4JZ8cfMmxHkI"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273f46b9d202509a8f7384b90de"}]},
+            "artists": [{"name": "Bruno Mars"}],
+            "name": "Uptown Funk",
+            "external_urls": {"spotify": "https://open.spotify.com/track/32OlwWuMpZ6b0aN2RZOeMS"}
+        }
+    ],
+    "sad": [
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2735ef878a782c987d38d82b605"}]},
+            "artists": [{"name": "Adele"}],
+            "name": "Someone Like You",
+            "external_urls": {"spotify": "https://open.spotify.com/track/1T3Sdf6j5S5HXxyc9dyD5W"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273e8b066f70c206551210d902b"}]},
+            "artists": [{"name": "Billie Eilish"}],
+            "name": "when the party's over",
+            "external_urls": {"spotify": "https://open.spotify.com/track/43zdsphuZLzwA9k4DJhU0I"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2734a5584794d8a1e9f911f3977"}]},
+            "artists": [{"name": "Lewis Capaldi"}],
+            "name": "Someone You Loved",
+            "external_urls": {"spotify": "https://open.spotify.com/track/7qEHsqek33rTcFNT9PFqLf"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2736c9e3e57dc88c33fde5379a2"}]},
+            "artists": [{"name": "Coldplay"}],
+            "name": "Fix You",
+            "external_urls": {"spotify": "https://open.spotify.com/track/7LVHVU3tWfcxj5aiPFEW4Q"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273e787cffec20aa2a396a61647"}]},
+            "artists": [{"name": "James Bay"}],
+            "name": "Let It Go",
+            "external_urls": {"spotify": "https://open.spotify.com/track/13HVjjWUZFaWilh2QUJKsP"}
+        }
+    ],
+    "relaxed": [
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273a40e3897b8aa1be97bf5992f"}]},
+            "artists": [{"name": "Bon Iver"}],
+            "name": "Holocene",
+            "external_urls": {"spotify": "https://open.spotify.com/track/3TnoWk9cUH4jfZ07L8feSr"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273c79b600289a80aaef74d155d"}]},
+            "artists": [{"name": "Sigur Rós"}],
+            "name": "Hoppípolla",
+            "external_urls": {"spotify": "https://open.spotify.com/track/6eTGxxQxiTFE6LfZHC33Wm"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273ce85c93e88cd5bbf98cc5366"}]},
+            "artists": [{"name": "Brian Eno"}],
+            "name": "1/1",
+            "external_urls": {"spotify": "https://open.spotify.com/track/7M4YXpgGQbcqZVG4ZF0Z2Q"}
+        }
+    ],
+    "energetic": [
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b27358ecb3e5ec3bbef70ee09a43"}]},
+            "artists": [{"name": "The Weeknd"}],
+            "name": "Blinding Lights",
+            "external_urls": {"spotify": "https://open.spotify.com/track/0VjIjW4GlUZAMYd2vXMi3b"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2732f44aec83b20e40f3baef73c"}]},
+            "artists": [{"name": "Dua Lipa"}],
+            "name": "Don't Start Now",
+            "external_urls": {"spotify": "https://open.spotify.com/track/3PfIrDoz19wz7qK7tYeu62"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273e787cffec20aa2a396a61647"}]},
+            "artists": [{"name": "Daft Punk"}],
+            "name": "Get Lucky",
+            "external_urls": {"spotify": "https://open.spotify.com/track/2Foc5Q5nqNiosCNqttzHof"}
+        }
+    ],
+    "default": [
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273ba5db46f4b838ef6027e6f96"}]},
+            "artists": [{"name": "Ed Sheeran"}],
+            "name": "Shape of You",
+            "external_urls": {"spotify": "https://open.spotify.com/track/7qiZfU4dY1lWllzX7mPBI3"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b273e8b066f70c206551210d902b"}]},
+            "artists": [{"name": "Billie Eilish"}],
+            "name": "bad guy",
+            "external_urls": {"spotify": "https://open.spotify.com/track/2Fxmhks0bxGSBdJ92vM42m"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b27358ecb3e5ec3bbef70ee09a43"}]},
+            "artists": [{"name": "The Weeknd"}],
+            "name": "Blinding Lights",
+            "external_urls": {"spotify": "https://open.spotify.com/track/0VjIjW4GlUZAMYd2vXMi3b"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2732f44aec83b20e40f3baef73c"}]},
+            "artists": [{"name": "Dua Lipa"}],
+            "name": "Don't Start Now",
+            "external_urls": {"spotify": "https://open.spotify.com/track/3PfIrDoz19wz7qK7tYeu62"}
+        },
+        {
+            "album": {"images": [{"url": "https://i.scdn.co/image/ab67616d0000b2736acc3a55cbab6f9ae5505aa4"}]},
+            "artists": [{"name": "Taylor Swift"}],
+            "name": "Shake It Off",
+            "external_urls": {"spotify": "https://open.spotify.com/track/0cqRj7pUJDkTCEsJkx8snD"}
+        }
+    ]
+}
+
+# Served in the same compact form as tracks from Spotify
+BACKUP_TRACKS_BY_MOOD = {
+    mood: [CompactTrack.from_spotify(track) for track in tracks]
+    for mood, tracks in BACKUP_TRACKS_BY_MOOD.items()
+}
+
+
+class TierCancelled(Exception):
+    """Raised inside a tier when the request no longer needs its result"""
+
+    outcome = 'cancelled'
+
+
+class RecommendationContext:
+    """Everything a recommendation tier needs for one request"""
+
+    def __init__(self, sp, mood_category, genre, user_key=None, on_tracks=None):
+        self.sp = sp
+        self.mood_category = mood_category
+        self.genre = genre
+        # The user's Spotify id, for per-user state such as recently seen tracks
+        self.user_key = user_key
+        # Called with each new batch of tracks that will be part of the answer
+        self.on_tracks = on_tracks
+        self._published = 0
+        # Set once a result has been chosen so tiers still running can stop early
+        self.cancelled = threading.Event()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise TierCancelled("Recommendation request already answered")
+
+    def publish(self, tracks):
+        """Pass on the tracks of the final answer that have not been published yet.
+
+        tracks is the answer so far, in its final order; only tracks beyond
+        those already published (up to TARGET_TRACKS) are sent on. Published
+        tracks can't be taken back, so only a tier that keeps whatever it has
+        gathered once it publishes (tier 1) does so as it goes; every other
+        answer is published by get_recommendations once it has been chosen.
+        """
+        if self.on_tracks is None:
+            return
+        batch = tracks[self._published:TARGET_TRACKS]
+        if batch:
+            self._published += len(batch)
+            self.on_tracks(batch)
+
+    def quiet(self):
+        """A copy for speculative work: shares cancellation but never publishes"""
+        quiet_ctx = copy.copy(self)
+        quiet_ctx.on_tracks = None
+        return quiet_ctx
+
+
+# Tier 1 results are cached as a pool of candidates per mood and (quantized)
+# audio features; each request samples from the pool, skipping tracks that
+# user saw recently. Set RECOMMENDATION_CACHE_BYTES=0 to turn this off.
+RECOMMENDATION_POOL_SIZE = int(os.getenv('RECOMMENDATION_POOL_SIZE', 100))
+recommendation_pool_cache = PoolCache(
+    max_bytes=int(os.getenv('RECOMMENDATION_CACHE_BYTES', 32 * 1024 * 1024)),
+    ttl=int(os.getenv('RECOMMENDATION_CACHE_TTL', 1800))
+)
+recently_seen = RecentlySeen(per_user=int(os.getenv('RECENTLY_SEEN_TRACKS', 60)))
+
+
+def _sample_for_user(ctx, pool):
+    return sample_pool(pool, TARGET_TRACKS, recently_seen.get(ctx.user_key))
+
+
+def remember_seen(ctx, tracks, source):
+    """Record the tracks the user is given, so pools leave them out for a while.
+
+    Only the chosen answer counts: tiers that lost (hedged mode runs them
+    all) were never shown, and the backup tracks are not from a pool.
+    """
+    if not source.startswith('fallback_'):
+        recently_seen.add(ctx.user_key, [t.id for t in tracks])
+
+
+# Tier 1 sends all of its recommendation attempts at once; this caps how many
+# of them run concurrently for a single request
+ADVANCED_ATTEMPTS = 5
+RECOMMENDATION_FANOUT = int(os.getenv('RECOMMENDATION_FANOUT', ADVANCED_ATTEMPTS))
+FANOUT_POOL_SIZE = int(os.getenv('FANOUT_POOL_SIZE', 32))
+
+_fanout_pool = None
+_fanout_pool_lock = threading.Lock()
+
+
+def _get_fanout_pool():
+    global _fanout_pool
+    with _fanout_pool_lock:
+        if _fanout_pool is None:
+            _fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_POOL_SIZE, thread_name_prefix='recommendation-fanout')
+        return _fanout_pool
+
+
+def _jitter_features(audio_features, tempo_spread, spread):
+    """Return a copy of audio_features nudged randomly to diversify recommendations"""
+    features = dict(audio_features)
+    if 'target_tempo' in features:
+        features['target_tempo'] += random.randint(-tempo_spread, tempo_spread)
+    for key in ('min_energy', 'max_energy', 'min_valence', 'max_valence'):
+        if key in features:
+            features[key] = max(0.0, min(1.0, features[key] + random.uniform(-spread, spread)))
+    return features
+
+
+def plan_advanced_attempts(audio_features, valid_genres, attempts=ADVANCED_ATTEMPTS):
+    """Build the (genres, features) parameter set for every tier-1 attempt up front.
+
+    Each attempt drifts a little further from the mood's features, like the
+    old retry loop did. The first three use the mood's genres; the rest use
+    a couple of popular genres for variety.
+    """
+    plans = []
+    # Slightly randomize audio features to get more diverse recommendations
+    features = _jitter_features(audio_features, 10, 0.1)
+    genres = list(valid_genres)
+    for attempt in range(1, attempts + 1):
+        if attempt > 1:
+            features = _jitter_features(features, 15, 0.15)
+            # Shuffle the genres to get different recommendations
+            if len(genres) > 1:
+                random.shuffle(genres)
+        if attempt > 3:
+            # Try with a completely different genre for more variety
+            different_genres = ["pop", "rock", "indie", "dance", "electronic", "hip-hop", "jazz", "classical"]
+            random.shuffle(different_genres)
+            genres = different_genres[:2]
+        plans.append((list(genres), features))
+    return plans
+
+
+def _fetch_attempts(ctx, plans, stage):
+    """Yield (attempt, response or exception) in attempt order.
+
+    Up to RECOMMENDATION_FANOUT attempts are in flight at once; when the
+    caller stops iterating, or the stage's budget runs out while waiting,
+    attempts that have not started are cancelled.
+    """
+    pool = _get_fanout_pool()
+    limit = max(1, RECOMMENDATION_FANOUT)
+    futures = {}
+
+    def submit(index):
+        genres, features = plans[index]
+        attempt_logger.debug("Attempt %s: Calling Spotify recommendations API with genres=%s, features=%s", index + 1, genres, features)
+        # The calls keep this thread's call priority and count against the stage
+        futures[index] = pool.submit(
+            contextvars.copy_context().run,
+            ctx.sp.recommendations,
+            seed_genres=genres,
+            limit=stage.fetch_limit,  # Request more than we need to filter
+            **features
+        )
+
+    for index in range(min(limit, len(plans))):
+        submit(index)
+    next_index = len(futures)
+    try:
+        for index in range(len(plans)):
+            if not wait_futures([futures[index]], timeout=stage.remaining()).done:
+                logger.debug("Stopping after %s attempts: the %ss budget ran out", index, stage.budget)
+                return
+            try:
+                result = futures[index].result()
+            except Exception as e:
+                result = e
+            # Keep the window full while we merge this result
+            if next_index < len(plans) and not ctx.cancelled.is_set():
+                submit(next_index)
+                next_index += 1
+            yield index + 1, result
+    finally:
+        for future in futures.values():
+            future.cancel()
+
+
+def advanced_parameters(mood_category, genre):
+    """The mood's plan from MOOD_PLANS: (audio_features, genres); callers must not change them"""
+    plan = MOOD_PLANS.get(mood_category)
+    if plan is None:
+        plan = make_mood_plan(mood_category, genre)
+    logger.debug("Using genres: %s with audio features: %s", plan[1], plan[0])
+    return plan
+
+
+def available_genres(valid_genres, spotify_genres):
+    """Keep the genres that are in Spotify's list of genre seeds"""
+    for genre in valid_genres:
+        if genre not in spotify_genres:
+            logger.warning("Genre '%s' not in Spotify's available genres!", genre)
+
+    # Ensure we're using actual available genres
+    valid_genres = [g for g in valid_genres if g in spotify_genres]
+    if not valid_genres:
+        valid_genres = ["pop"]
+        logger.warning("No valid genres found, falling back to 'pop'")
+    return valid_genres
+
+
+def finish_advanced(ctx, collector, errors, cache_key, stage):
+    """Turn the merged tier-1 attempts into the answer, caching the pool when there is a key"""
+    stage.gathered = len(collector)
+    # Take the tracks or whatever we got
+    if len(collector) >= TARGET_TRACKS and cache_key is not None:
+        recommendation_pool_cache.put(cache_key, collector.tracks)
+        logger.debug("Cached a pool of %s advanced recommendations", len(collector))
+    if collector.tracks:
+        tracks = collector.tracks[:TARGET_TRACKS]
+        logger.debug("Successfully got %s advanced recommendations", len(tracks))
+        return tracks
+    if errors:
+        # Surface an authentication problem over any other failure
+        raise next((e for e in errors if is_auth_error(e)), errors[0])
+    raise stage.no_tracks("No valid tracks found after multiple attempts")
+
+
+# Method 1: Try advanced recommendations with audio features based on mood
+def advanced_recommendations(ctx, stage):
+    logger.debug("Trying advanced recommendations for mood: %s", ctx.mood_category)
+    audio_features, valid_genres = advanced_parameters(ctx.mood_category, ctx.genre)
+    
+    # Verify our genres are in Spotify's (cached) list of genre seeds
+    valid_genres = available_genres(valid_genres, get_genre_seeds(ctx.sp))
+    
+    # Serve from a cached pool of candidates for this mood when we have one
+    cache_key = None
+    if recommendation_pool_cache.enabled:
+        cache_key = pool_cache_key(ctx.mood_category, audio_features, valid_genres)
+        pool = recommendation_pool_cache.get(cache_key)
+        if pool is not None:
+            logger.debug("Sampling advanced recommendations from a cached pool of %s tracks", len(pool))
+            return _sample_for_user(ctx, pool)
+
+    # Send every attempt at once and merge the results in attempt order, so
+    # the mood's own genres always come before the variety attempts. When
+    # caching, keep every attempt's tracks to build a pool for later requests.
+    ctx.check_cancelled()
+    check_operations(stage.operations)
+    collector = TrackCollector(stage.target if cache_key is None else RECOMMENDATION_POOL_SIZE)
+    errors = []
+    attempts = _fetch_attempts(ctx, plan_advanced_attempts(audio_features, valid_genres, stage.attempts), stage)
+    try:
+        for attempt_count, current_recs in attempts:
+            if isinstance(current_recs, CircuitOpenError):
+                # The other attempts would be turned away by the same open circuit
+                errors.append(current_recs)
+                break
+            if isinstance(current_recs, Exception):
+                logger.warning("Attempt %s: Recommendations call failed: %s", attempt_count, current_recs)
+                errors.append(current_recs)
+                continue
+
+            # Verify we got actual tracks, keeping new ones with proper images
+            if current_recs and 'tracks' in current_recs and current_recs['tracks']:
+                added = collector.extend(current_recs['tracks'])
+                attempt_logger.debug("Attempt %s: Found %s valid tracks", attempt_count, added)
+                ctx.publish(collector.tracks)
+            
+            # If we have enough tracks, stop waiting for the remaining attempts
+            if collector.full:
+                break
+    finally:
+        attempts.close()
+    
+    return finish_advanced(ctx, collector, errors, cache_key, stage)
+
+
+# Tiers 2-5 gather more candidates than they return and keep the ones whose
+# audio features fit the mood best. Set MOOD_RERANK=0 to turn this off.
+MOOD_RERANK = os.getenv('MOOD_RERANK', '1') == '1'
+RERANK_CANDIDATES = int(os.getenv('RERANK_CANDIDATES', 40))
+# Default tracks asked for per recommendations call in tiers 2 and 3
+CANDIDATE_FETCH_LIMIT = 20 if MOOD_RERANK else 10
+
+
+def candidate_target(minimum=TARGET_TRACKS):
+    """How many candidates a tier should collect before choosing its tracks"""
+    return max(minimum, RERANK_CANDIDATES) if MOOD_RERANK else minimum
+
+
+def rerank_plan(ctx, tracks):
+    """Return (mood features, cached features by id, [id batches to fetch]), or None to skip re-ranking"""
+    mood_features = MOOD_FEATURES.get(ctx.mood_category)
+    if not MOOD_RERANK or not mood_features or len(tracks) <= TARGET_TRACKS:
+        return None
+    found, missing = cached_features([track.id for track in tracks])
+    return mood_features, found, feature_batches(missing)
+
+
+def rerank_failed(error):
+    """Re-ranking is best effort: rank what we have unless the user's token is gone"""
+    if is_auth_error(error):
+        raise error
+    if isinstance(error, (CircuitOpenError, RateLimitedError)):
+        logger.debug("Re-ranking with cached audio features only: %s", error)
+    else:
+        logger.warning("Failed to get audio features for re-ranking: %s", error)
+
+
+def rerank(ctx, tracks, stage):
+    """Return the TARGET_TRACKS candidates whose audio features best fit the mood"""
+    stage.gathered = len(tracks)
+    plan = rerank_plan(ctx, tracks)
+    if plan is None:
+        return tracks[:TARGET_TRACKS]
+    mood_features, found, batches = plan
+    for batch in batches:
+        ctx.check_cancelled()
+        if stage.over_budget():
+            logger.debug("Re-ranking with cached audio features only: the %ss budget ran out", stage.budget)
+            break
+        try:
+            remember_features(batch, ctx.sp.audio_features(batch), found)
+        except Exception as e:
+            rerank_failed(e)
+            break
+    logger.debug("Re-ranking %s candidates after %s audio feature calls", len(tracks), len(batches))
+    return rank_tracks(tracks, found, mood_features, TARGET_TRACKS)
+
+
+# A user's medium-term top tracks, and the candidates recommended from them,
+# change slowly, so tier 2 keeps them per user: in memory for the most
+# recent USER_TRACKS_CACHE_ENTRIES users, in front of a store on disk that
+# all workers share and that survives restarts. A login fills the entry in
+# the background; a stale entry is still used while it is refreshed.
+USER_TRACKS_CACHE_BACKEND = os.getenv('USER_TRACKS_CACHE_BACKEND', 'sqlite')  # 'sqlite', 'dbm', 'memory' or 'off'
+USER_TRACKS_CACHE_PATH = os.getenv('USER_TRACKS_CACHE_PATH') or ('/tmp/user_tracks.db' if os.getenv('VERCEL') else 'user_tracks.db')
+USER_TRACKS_CACHE_TTL = int(os.getenv('USER_TRACKS_CACHE_TTL', 12 * 3600))
+USER_TRACKS_CACHE_STALE_TTL = int(os.getenv('USER_TRACKS_CACHE_STALE_TTL', 7 * 24 * 3600))
+USER_TRACKS_CACHE_ENTRIES = int(os.getenv('USER_TRACKS_CACHE_ENTRIES', 1000))  # About 25 KB each
+
+user_tracks_cache = None
+if USER_TRACKS_CACHE_BACKEND != 'off':
+    user_tracks_cache = TTLCache(
+        backend=(
+            MemoryBackend(USER_TRACKS_CACHE_ENTRIES) if USER_TRACKS_CACHE_BACKEND == 'memory'
+            else make_backend(USER_TRACKS_CACHE_BACKEND, USER_TRACKS_CACHE_PATH)
+        ),
+        ttl=USER_TRACKS_CACHE_TTL,
+        stale_ttl=USER_TRACKS_CACHE_STALE_TTL,
+        max_entries=USER_TRACKS_CACHE_ENTRIES
+    )
+
+
+def fetch_user_tracks(sp, stage, limit, ctx=None):
+    """Return {'top_tracks': ids, 'candidates': tracks} recommended from the user's top tracks.
+
+    With a ctx, the calls stop once the request has been answered.
+    """
+    check_operations(stage.operations)
+    top_tracks = sp.current_user_top_tracks(limit=stage.top_tracks, time_range='medium_term')
+    
+    if not (top_tracks and 'items' in top_tracks and top_tracks['items']):
+        logger.warning("No user top tracks found")
+        raise Exception("No top tracks found")
+
+    # Use track IDs from user's top tracks as seeds
+    top_track_ids = [track['id'] for track in top_tracks['items'] if track.get('id')]
+    track_ids = top_track_ids[:stage.seeds]
+    if not track_ids:
+        raise Exception("No valid track IDs found in user's top tracks")
+
+    # Make multiple calls with different seeds for variety
+    collector = TrackCollector(limit)
+    for seed_id in track_ids:
+        if ctx is not None:
+            ctx.check_cancelled()
+        if stage.over_budget():
+            break
+        top_based_recommendations = sp.recommendations(
+            seed_tracks=[seed_id],
+            limit=stage.fetch_limit
+        )
+        
+        if top_based_recommendations and 'tracks' in top_based_recommendations:
+            # Add unique tracks with good images
+            collector.extend(top_based_recommendations['tracks'])
+        if collector.full:
+            break
+    return {'top_tracks': top_track_ids, 'candidates': collector.tracks}
+
+
+def user_tracks_stage():
+    """Tier 2's stage, whose settings apply to cache fills made outside a request"""
+    return next(stage for stage in STAGES if stage.source == "spotify_user_top_tracks")
+
+
+def load_user_tracks(sp):
+    """A user's user_tracks_cache entry, fetched at speculative priority since nobody is waiting for it"""
+    stage = user_tracks_stage()
+    with call_priority(SPECULATIVE):
+        user_tracks = fetch_user_tracks(sp, stage, stage.cached_candidates)
+    if not user_tracks['candidates']:
+        # Keep whatever is cached rather than an empty entry
+        raise Exception("No valid tracks recommended from the user's top tracks")
+    return user_tracks
+
+
+def prefetch_user_tracks(sp, user_key):
+    """Fill a user's user_tracks_cache entry (after login), so tier 2 finds it ready"""
+    if user_tracks_cache is not None:
+        user_tracks = user_tracks_cache.set(user_key, load_user_tracks(sp))
+        logger.debug("Cached %s candidates from the user's top tracks", len(user_tracks['candidates']))
+
+
+def cached_user_tracks(ctx, stage):
+    """The user's user_tracks_cache entry: loaded now when there is none, in the background once stale"""
+    cached = user_tracks_cache.peek(ctx.user_key)
+    if cached is None:
+        user_tracks = fetch_user_tracks(ctx.sp, stage, stage.cached_candidates, ctx)
+        if user_tracks['candidates']:
+            user_tracks_cache.set(ctx.user_key, user_tracks)
+        return user_tracks
+    user_tracks, fresh = cached
+    if not fresh:
+        sp = ctx.sp
+        user_tracks_cache.refresh_in_background(ctx.user_key, lambda: load_user_tracks(sp))
+    return user_tracks
+
+
+# Method 2: Try with user's top tracks for diversity
+def user_top_tracks_recommendations(ctx, stage):
+    logger.debug("Trying to get recommendations based on user's top tracks")
+    target = candidate_target(stage.target)
+    if user_tracks_cache is None or ctx.user_key is None:
+        candidates = fetch_user_tracks(ctx.sp, stage, target, ctx)['candidates']
+    else:
+        # Vary the answer by leaving out what the user was shown recently
+        pool = cached_user_tracks(ctx, stage)['candidates']
+        candidates = sample_pool(pool, min(target, len(pool)), recently_seen.get(ctx.user_key))
+                    
+    if candidates:
+        logger.debug("Successfully got %s recommendations based on user's top tracks", len(candidates))
+        return rerank(ctx, candidates, stage)
+    raise stage.no_tracks("No valid tracks after filtering user top tracks recommendations")
+
+
+# Method 3: Try simpler genre-based recommendations
+def simple_genre_recommendations(ctx, stage):
+    sp = ctx.sp
+    logger.debug("Trying simple genre-based recommendations")
+    check_operations(stage.operations)
+    
+    # Try with popular genres but pick more random ones for variety
+    popular_genres = ["pop", "rock", "hip-hop", "dance", "electronic", "indie", "r-n-b", "jazz", "classical"]
+    random.shuffle(popular_genres)
+    
+    # Make multiple calls with different genre combinations
+    collector = TrackCollector(candidate_target(stage.target))
+    per_call = stage.genres_per_call
+    for i in range(stage.calls):  # Try a few different genre combinations
+        ctx.check_cancelled()
+        selected_genres = popular_genres[i*per_call:(i+1)*per_call]
+        if not selected_genres or stage.over_budget():
+            break
+            
+        logger.debug("Using popular genres '%s' for simple recommendations", selected_genres)
+        
+        # Fall back to a simpler request with minimal parameters
+        simple_recommendations = sp.recommendations(seed_genres=selected_genres, limit=stage.fetch_limit)
+        
+        # Add unique tracks with good images
+        if simple_recommendations and 'tracks' in simple_recommendations:
+            collector.extend(simple_recommendations['tracks'])
+        if collector.full:
+            break
+    
+    if collector.tracks:
+        logger.debug("Got %s simple recommendations", len(collector))
+        logger.debug("Successfully got simple genre recommendations")
+        return rerank(ctx, collector.tracks, stage)
+    raise stage.no_tracks("No valid tracks after filtering")
+
+
+# Method 4: Try with featured playlists as a more reliable option
+def featured_playlist_tracks(ctx, stage):
+    sp = ctx.sp
+    logger.debug("Trying to get tracks from featured playlists")
+    check_operations(stage.operations)
+    playlists = sp.featured_playlists(limit=stage.playlists_listed)
+    
+    if not (playlists and 'playlists' in playlists and playlists['playlists']['items']):
+        raise Exception("No featured playlists found")
+
+    # Try multiple playlists to get more variety; collect a few extra so the
+    # shuffle (and re-ranking) below has something to choose from
+    collector = TrackCollector(candidate_target(stage.target))
+    
+    for playlist_item in playlists['playlists']['items'][:stage.playlists]:
+        ctx.check_cancelled()
+        if stage.over_budget():
+            break
+        try:
+            playlist_id = playlist_item['id']
+            attempt_logger.debug("Checking featured playlist: %s (ID: %s)", playlist_item['name'], playlist_id)
+            
+            tracks_response = sp.playlist_tracks(playlist_id, limit=stage.tracks_per_playlist)
+            
+            if tracks_response and 'items' in tracks_response:
+                # Add new unique tracks to our collection
+                added = collector.extend(item.get('track') for item in tracks_response['items'])
+                attempt_logger.debug("Found %s valid tracks in playlist %s", added, playlist_item['name'])
+                
+                # If we have enough tracks, stop looking at more playlists
+                if collector.full:
+                    break
+        except Exception as playlist_err:
+            logger.warning("Error processing playlist %s: %s", playlist_id, playlist_err)
+    
+    # Check if we found any tracks
+    if collector.tracks:
+        # Randomize the order for variety
+        all_tracks = collector.tracks
+        random.shuffle(all_tracks)
+        tracks = rerank(ctx, all_tracks, stage)
+        logger.debug("Successfully got %s tracks from featured playlists", len(tracks))
+        return tracks
+    raise stage.no_tracks("No valid tracks found in any featured playlists")
+
+
+# Method 5: Try with new releases
+def new_release_tracks(ctx, stage):
+    sp = ctx.sp
+    logger.debug("Trying to get tracks from new releases")
+    check_operations(stage.operations)
+    new_releases = sp.new_releases(limit=stage.albums_listed)
+    if not (new_releases and 'albums' in new_releases and new_releases['albums']['items']):
+        raise Exception("No new releases found")
+
+    # Get more albums than before
+    albums = new_releases['albums']['items'][:stage.albums]
+    collector = TrackCollector(candidate_target(stage.target))
+    
+    for album in albums:
+        ctx.check_cancelled()
+        if stage.over_budget():
+            break
+        try:
+            album_id = album['id']
+            album_name = album.get('name', 'Unknown Album')
+            attempt_logger.debug("Checking album: %s (ID: %s)", album_name, album_id)
+            
+            # Check if album has valid image
+            if has_valid_album_art(album):
+                album_tracks = sp.album_tracks(album_id, limit=stage.tracks_per_album)
+                if album_tracks and 'items' in album_tracks:
+                    kept = album_tracks['items'][:stage.tracks_kept_per_album]
+                    # Format tracks to match recommendations format
+                    for track in kept:
+                        track_with_album = track.copy()
+                        # Add album info if it's missing
+                        if 'album' not in track_with_album:
+                            track_with_album['album'] = album
+                        
+                        # Only add if not already in our list
+                        collector.add(track_with_album)
+                    
+                    attempt_logger.debug("Added %s tracks from album %s", len(kept), album_name)
+                    
+                    # If we have enough tracks, stop processing more albums
+                    if collector.full:
+                        break
+        except Exception as album_err:
+            logger.warning("Error getting album tracks: %s", album_err)
+    
+    if collector.tracks:
+        # Randomize the track order for variety
+        all_tracks = collector.tracks
+        random.shuffle(all_tracks)
+        tracks = rerank(ctx, all_tracks, stage)
+        logger.debug("Successfully got %s tracks from new releases", len(tracks))
+        return tracks
+    raise stage.no_tracks("No tracks found in new releases")
+
+
+# Optional local catalog of tracks and audio features (see catalog.py). When
+# it is set, tracks matching the mood are picked from it before any
+# Spotify call is made.
+LOCAL_CATALOG_PATH = os.getenv('LOCAL_CATALOG_PATH')
+if LOCAL_CATALOG_PATH:
+    from catalog import open_catalog
+
+_catalog_pools = {}
+
+
+# Method 0: Match the mood's audio features against the local catalog
+def local_catalog_recommendations(ctx, stage):
+    audio_features = MOOD_FEATURES.get(ctx.mood_category)
+    if not audio_features:
+        raise Exception(f"No audio features for mood: {ctx.mood_category}")
+    # The catalog doesn't change while we run, so each mood is only queried once
+    pool = _catalog_pools.get(ctx.mood_category)
+    if pool is None:
+        catalog = open_catalog(LOCAL_CATALOG_PATH)
+        pool = catalog.tracks(catalog.query(audio_features, RECOMMENDATION_POOL_SIZE))
+        _catalog_pools[ctx.mood_category] = pool
+        logger.debug("Local catalog has %s candidates for mood: %s", len(pool), ctx.mood_category)
+    if not pool:
+        raise Exception("No tracks in the local catalog match this mood")
+    return _sample_for_user(ctx, pool)
+
+
+# Method 6: Use hardcoded backup tracks based on mood
+def backup_tracks(mood_category):
+    """Return (tracks, source) from the hardcoded backup list for this mood"""
+    if mood_category in BACKUP_TRACKS_BY_MOOD:
+        logger.warning("Using backup tracks for mood: %s", mood_category)
+        return BACKUP_TRACKS_BY_MOOD[mood_category], f"fallback_{mood_category}"
+    logger.warning("Using default backup tracks")
+    return BACKUP_TRACKS_BY_MOOD['default'], "fallback_default"
+
+
+# Recommendation tiers in priority order as pipeline stages (see pipeline.py),
+# with their default settings. operations are the Spotify operations a stage
+# calls when it can't answer from a cache: a stage checks their circuits
+# (check_operations) only once it has to call Spotify, so it still answers
+# from its cache while an endpoint is down. budget is in seconds; target is how many candidates
+# a stage gathers before it stops calling Spotify; the rest are call sizes.
+STAGES = [
+    Stage("spotify_advanced", "Advanced recommendations", advanced_recommendations,
+          operations=('recommendations',), budget=5.0, target=TARGET_TRACKS,
+          attempts=ADVANCED_ATTEMPTS, fetch_limit=20),
+    Stage("spotify_user_top_tracks", "User top tracks approach", user_top_tracks_recommendations,
+          operations=('top_tracks', 'recommendations'), budget=4.0, target=TARGET_TRACKS,
+          top_tracks=10, seeds=3, fetch_limit=CANDIDATE_FETCH_LIMIT, cached_candidates=60),
+    Stage("spotify_simple", "Simple genre recommendations", simple_genre_recommendations,
+          operations=('recommendations',), budget=4.0, target=TARGET_TRACKS,
+          calls=3, genres_per_call=3, fetch_limit=CANDIDATE_FETCH_LIMIT),
+    Stage("spotify_featured_playlist", "Featured playlist approach", featured_playlist_tracks,
+          operations=('featured_playlists', 'playlist_tracks'), budget=4.0, target=15,
+          playlists_listed=8, playlists=5, tracks_per_playlist=10),
+    Stage("spotify_new_releases", "New releases approach", new_release_tracks,
+          operations=('new_releases', 'album_tracks'), budget=4.0, target=15,
+          albums_listed=15, albums=8, tracks_per_album=5, tracks_kept_per_album=2),
+]
+if LOCAL_CATALOG_PATH:
+    STAGES.insert(0, Stage("local_catalog", "Local catalog", local_catalog_recommendations, needs_mood_features=True))
+
+PIPELINE_SETTINGS = load_config()
+configure_stages(STAGES, PIPELINE_SETTINGS)
+PIPELINES = build_pipelines(STAGES, MOOD_FEATURES, PIPELINE_SETTINGS)
+
+
+def pipeline_for(mood_category):
+    """The stages to try for a mood, in order"""
+    return PIPELINES.get(mood_category, PIPELINES[None])
+
+# 'sequential' runs the tiers one after another, 'hedged' runs them all at
+# once and keeps the result of the highest-priority tier that succeeds
+RECOMMENDATION_MODE = os.getenv('RECOMMENDATION_MODE', 'sequential')
+HEDGE_MAX_WORKERS = int(os.getenv('HEDGE_MAX_WORKERS', 16))
+HEDGE_DEADLINE = float(os.getenv('HEDGE_DEADLINE', 10.0))
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def _get_hedge_pool():
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix='recommendation-tier')
+        return _hedge_pool
+
+
+def tier_priorities(stages):
+    """Spotify call priority per source when tiers run at once.
+
+    The first tier that can call Spotify is the one whose answer is wanted;
+    the others are speculative, so they give way to it when calls are rate
+    limited. A tier with an open circuit can only answer from a cache.
+    """
+    primary = next(
+        (stage.source for stage in stages if stage.operations and not open_operation(stage.operations)),
+        None
+    )
+    return {stage.source: PRIMARY if stage.source == primary else SPECULATIVE for stage in stages}
+
+
+def run_tier(stage, ctx, priority=PRIMARY):
+    """Run one tier within its budget, recording how long it took, how it ended and what it produced"""
+    run = stage.start()
+    with tier_span(stage.source, ctx.mood_category), call_priority(priority):
+        tracks = stage.run(ctx, run)
+    record_stage_output(stage.source, max(run.gathered, len(tracks)), len(tracks))
+    return tracks
+
+
+def _log_tier_failure(name, source, mood_category, error):
+    if isinstance(error, CircuitOpenError):
+        # It needed an endpoint that is known to be down (and had no cached answer)
+        tiers_skipped.inc(source, mood_category)
+    if isinstance(error, (CircuitOpenError, RateLimitedError)):
+        # The endpoint is known to be down, or calling it would wait too long
+        # for the rate limit; there is nothing new to report
+        logger.debug("%s skipped: %s", name, error)
+        return
+    logger.warning("%s failed: %s", name, error)
+    if source == "spotify_advanced" and not isinstance(error, (TierCancelled, StageOverBudget)):
+        traceback.print_exc()
+
+
+def run_tiers_sequential(ctx):
+    """Try each tier in order until one returns tracks"""
+    for stage in pipeline_for(ctx.mood_category):
+        try:
+            return run_tier(stage, ctx), stage.source
+        except Exception as e:
+            if is_auth_error(e):
+                raise SpotifyAuthError(str(e)) from e
+            _log_tier_failure(stage.name, stage.source, ctx.mood_category, e)
+    return backup_tracks(ctx.mood_category)
+
+
+def run_tiers_hedged(ctx, deadline=None):
+    """Run every tier concurrently and keep the highest-priority success.
+
+    Tiers are awaited in priority order, so a lower tier's result is only
+    used once every tier above it has failed. When the deadline passes the
+    best result already finished is used instead. Tiers still running are
+    told to stop and tiers still queued are cancelled. Tiers run on a quiet
+    copy of ctx, since their tracks are only final once they have won.
+    """
+    deadline_at = time.monotonic() + (HEDGE_DEADLINE if deadline is None else deadline)
+    pool = _get_hedge_pool()
+    tier_ctx = ctx.quiet()
+    stages = pipeline_for(ctx.mood_category)
+    priorities = tier_priorities(stages)
+    futures = [
+        (stage.source, stage.name, pool.submit(run_tier, stage, tier_ctx, priorities[stage.source]))
+        for stage in stages
+    ]
+    try:
+        for source, name, future in futures:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                return future.result(timeout=remaining), source
+            except FutureTimeoutError:
+                logger.warning("Recommendation deadline reached while waiting for %s", name)
+                break
+            except Exception as e:
+                if is_auth_error(e):
+                    raise SpotifyAuthError(str(e)) from e
+                _log_tier_failure(name, source, ctx.mood_category, e)
+
+        # Out of time: use the best tier that has already finished
+        for source, name, future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                return future.result(), source
+    finally:
+        ctx.cancelled.set()
+        for _, _, future in futures:
+            future.cancel()
+    return backup_tracks(ctx.mood_category)
+
+
+def get_recommendations(ctx, mode=None):
+    """Return (tracks, source) for this request using the configured mode"""
+    mode = mode or RECOMMENDATION_MODE
+    started = time.perf_counter()
+    if mode == 'hedged':
+        tracks, source = run_tiers_hedged(ctx)
+    else:
+        tracks, source = run_tiers_sequential(ctx)
+    record_recommendation(source, ctx.mood_category, started)
+    remember_seen(ctx, tracks, source)
+    # Tiers that only know their answer at the end publish it here
+    ctx.publish(tracks)
+    return tracks, source
+
+
+# Batch requests run one cascade per mood category; this caps how many of
+# those cascades run at once across all batch requests
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', 4))
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+
+def _get_batch_pool():
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix='recommendation-batch')
+        return _batch_pool
+
+
+def get_recommendations_many(contexts, mode=None):
+    """Run get_recommendations() for several contexts at once.
+
+    Returns one (tracks, source) pair or exception per context, in order.
+    """
+    futures = [_get_batch_pool().submit(get_recommendations, ctx, mode) for ctx in contexts]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
@@ -0,0 +1,199 @@
+"""Server-side Flask sessions: the cookie carries only an opaque session id.
+
+Session data lives in a SQLite file shared by the worker processes on the
+host, with an in-process LRU in front so most requests never read the file.
+A session written by one request (say, a refreshed Spotify token) is seen at
+once by the other requests in the same process, and by other processes once
+their cached copy is older than SESSION_LOCAL_TTL.
+"""
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SecureCookieSession, SessionInterface, session_json_serializer
+
+from sqlite_connection import SqliteConnection
+
+logger = logging.getLogger('moosic.sessions')
+
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH') or ('/tmp/sessions.db' if os.getenv('VERCEL') else 'sessions.db')
+SESSION_TTL = int(os.getenv('SESSION_TTL', 30 * 24 * 3600))  # Seconds a session is kept after its last write
+SESSION_CACHE_ENTRIES = int(os.getenv('SESSION_CACHE_ENTRIES', 10000))  # Sessions cached per process
+SESSION_LOCAL_TTL = float(os.getenv('SESSION_LOCAL_TTL', 5))  # Seconds a cached session is used before re-reading it
+SESSION_PURGE_INTERVAL = 3600  # Seconds between sweeps for expired rows
+
+# Longest cookie value taken as a session id (token_urlsafe(32) is 43 characters)
+MAX_SID_LENGTH = 64
+
+
+class SessionStore:
+    """Session data by id in SQLite, fronted by a per-process LRU"""
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL, max_entries=SESSION_CACHE_ENTRIES,
+                 local_ttl=SESSION_LOCAL_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.hits = 0
+        self.misses = 0
+        # sid -> (serialized data or None if there is none, expires_at, read_at)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._db = SqliteConnection(
+            path, 'CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._purged_at = 0.0
+
+    def _execute(self, sql, params=()):
+        return self._db.execute(sql, params)
+
+    def _remember(self, sid, entry):
+        with self._cache_lock:
+            self._cache[sid] = entry
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def get(self, sid):
+        """The session data stored under sid as a dict, or None"""
+        now = time.time()
+        with self._cache_lock:
+            entry = self._cache.get(sid)
+            if entry is not None and now - entry[2] < self.local_ttl:
+                self._cache.move_to_end(sid)
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        if entry is None:
+            rows = self._execute('SELECT data, expires_at FROM sessions WHERE id = ?', (sid,))
+            # Unknown ids are cached too, so a stale cookie doesn't reach SQLite on every request
+            entry = (rows[0][0], rows[0][1], now) if rows else (None, 0.0, now)
+            self._remember(sid, entry)
+        data, expires_at, _ = entry
+        if data is None or now >= expires_at:
+            return None
+        return session_json_serializer.loads(data)
+
+    def set(self, sid, data):
+        now = time.time()
+        serialized = session_json_serializer.dumps(dict(data))
+        expires_at = now + self.ttl
+        self._execute(
+            'INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)',
+            (sid, serialized, expires_at)
+        )
+        self._remember(sid, (serialized, expires_at, now))
+        if now - self._purged_at > SESSION_PURGE_INTERVAL:
+            self._purged_at = now
+            self._execute('DELETE FROM sessions WHERE expires_at < ?', (now,))
+
+    def delete(self, sid):
+        self._execute('DELETE FROM sessions WHERE id = ?', (sid,))
+        with self._cache_lock:
+            self._cache.pop(sid, None)
+
+    def stats(self):
+        with self._cache_lock:
+            return {'cached': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+
+class ServerSession(SecureCookieSession):
+    """A session whose data is kept in a SessionStore under sid (None until first saved)"""
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.regenerate_sid = False
+
+    def regenerate(self):
+        """Move the session to a new id when it is saved, dropping the old row (call at login)"""
+        self.regenerate_sid = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface that keeps only the session id in the cookie.
+
+    Ids are random and unguessable, so the cookie needs no signature. Static
+    file requests don't look their session up at all.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid or len(sid) > MAX_SID_LENGTH:
+            return ServerSession()
+        if app.static_url_path and request.path.startswith(app.static_url_path + '/'):
+            return ServerSession(sid=sid)
+        try:
+            data = self.store.get(sid)
+        except sqlite3.Error as e:
+            logger.error("Failed to read session: %s", e)
+            return ServerSession()
+        if data is None:
+            return ServerSession()  # Expired or unknown: start a new session
+        return ServerSession(data, sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # A session cleared to empty is removed along with its cookie
+        if not session:
+            if session.modified:
+                if session.sid:
+                    try:
+                        self.store.delete(session.sid)
+                    except sqlite3.Error as e:
+                        logger.error("Failed to delete session: %s", e)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+                response.vary.add('Cookie')
+            return
+
+        new_sid = False
+        if session.modified:
+            if session.regenerate_sid and session.sid is not None:
+                try:
+                    self.store.delete(session.sid)
+                except sqlite3.Error as e:
+                    logger.error("Failed to delete session: %s", e)
+                session.sid = None
+            session.regenerate_sid = False
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(32)
+                new_sid = True
+            try:
+                self.store.set(session.sid, session)
+            except sqlite3.Error as e:
+                logger.error("Failed to save session: %s", e)
+                return
+
+        # The id only changes when a session is created or regenerated; permanent sessions
+        # may still want their cookie's expiry pushed back
+        if new_sid or (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=httponly,
+                domain=domain,
+                path=path,
+                secure=secure,
+                samesite=samesite,
+            )
+            response.vary.add('Cookie')
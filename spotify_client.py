@@ -0,0 +1,138 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from spotipy import Spotify
+from spotipy.exceptions import SpotifyException
+from urllib3.util.retry import Retry
+
+from circuit_breaker import guarded, operation_for
+from metrics import upstream_span
+from rate_limiter import RATE_LIMIT, get_limiter, is_throttled
+
+# One pooled HTTP session per worker process, shared by every user's client.
+# Keeping connections alive saves a TLS handshake on most Spotify calls.
+SPOTIFY_POOL_CONNECTIONS = int(os.getenv('SPOTIFY_POOL_CONNECTIONS', 4))  # Hosts to keep pools for
+SPOTIFY_POOL_MAXSIZE = int(os.getenv('SPOTIFY_POOL_MAXSIZE', 32))  # Connections kept per host
+SPOTIFY_TIMEOUT = float(os.getenv('SPOTIFY_TIMEOUT', 5))
+SPOTIFY_RETRIES = int(os.getenv('SPOTIFY_RETRIES', 3))
+# Base URL of the Web API; point it at a local fake for load tests
+SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1/')
+
+# Statuses retried with backoff inside a call. With rate limiting on, 429s
+# come back to the client instead, which pauses every call for Retry-After.
+RETRY_STATUS_CODES = tuple(
+    status for status in Spotify.default_retry_codes if status != 429 or not RATE_LIMIT
+)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that counts requests so connection reuse can be reported"""
+
+    def __init__(self, *args, **kwargs):
+        self.requests_sent = 0
+        self._count_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        with self._count_lock:
+            self.requests_sent += 1
+        return super().send(request, *args, **kwargs)
+
+    def connections_opened(self):
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+
+class PooledSpotify(Spotify):
+    """Spotify client that borrows the shared session instead of owning it"""
+
+    def __del__(self):
+        # spotipy closes its session when a client is garbage collected; the
+        # pooled session outlives every client, so leave it open
+        pass
+
+    def _internal_call(self, method, url, payload, params):
+        # Every API call goes through here: wait for the rate limit, skip
+        # endpoints that are known to be down and time the rest
+        operation = operation_for(url)
+        if not RATE_LIMIT:
+            with guarded(operation), upstream_span(operation):
+                return super()._internal_call(method, url, payload, params)
+        limiter = get_limiter()
+        for attempt in range(SPOTIFY_RETRIES + 1):
+            limiter.acquire()
+            try:
+                with guarded(operation), upstream_span(operation):
+                    return super()._internal_call(method, url, payload, params)
+            except SpotifyException as e:
+                if not is_throttled(e):
+                    raise
+                limiter.throttled_by_spotify(operation, e)
+                if attempt == SPOTIFY_RETRIES:
+                    raise
+
+
+_session = None
+_session_pid = None
+_adapter = None
+_session_lock = threading.Lock()
+
+
+def _build_session():
+    retry = Retry(
+        total=SPOTIFY_RETRIES,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=SPOTIFY_RETRIES,
+        backoff_factor=0.3,
+        status_forcelist=RETRY_STATUS_CODES,
+        # Otherwise urllib3 would still sleep through a 429's Retry-After on its own
+        respect_retry_after_header=not RATE_LIMIT
+    )
+    adapter = CountingHTTPAdapter(
+        pool_connections=SPOTIFY_POOL_CONNECTIONS,
+        pool_maxsize=SPOTIFY_POOL_MAXSIZE,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session, adapter
+
+
+def get_session():
+    """Return this process's pooled session, building a new one after a fork"""
+    global _session, _session_pid, _adapter
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session, _adapter = _build_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def make_client(access_token):
+    """Build a Spotify client for one user's access token on top of the shared pool"""
+    client = PooledSpotify(
+        auth=access_token,
+        requests_session=get_session(),
+        requests_timeout=SPOTIFY_TIMEOUT
+    )
+    client.prefix = SPOTIFY_API_URL
+    return client
+
+
+def connection_stats():
+    """Counters showing how often the pool reused a connection instead of opening one"""
+    adapter = _adapter if _session_pid == os.getpid() else None
+    if adapter is None:
+        return {'requests': 0, 'connections_opened': 0, 'connections_reused': 0}
+    requests_sent = adapter.requests_sent
+    opened = adapter.connections_opened()
+    return {
+        'requests': requests_sent,
+        'connections_opened': opened,
+        'connections_reused': max(0, requests_sent - opened),
+    }
@@ -0,0 +1,36 @@
+"""A SQLite file shared by the worker processes on a host (sessions, caches)."""
+import os
+import sqlite3
+import threading
+
+
+class SqliteConnection:
+    """Runs statements on path over one connection per process, shared by its threads.
+
+    The connection is opened on first use in each process, in WAL mode so
+    readers don't wait for a writer, and runs schema (a CREATE TABLE IF NOT
+    EXISTS statement) once opened. Writers wait up to timeout seconds for
+    another process's lock before sqlite3.OperationalError is raised.
+    """
+
+    def __init__(self, path, schema, timeout=5):
+        self.path = path
+        self.schema = schema
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def execute(self, sql, params=()):
+        """Run one statement and return all its rows"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # A connection inherited over fork is not safe to use
+                self._connection = sqlite3.connect(
+                    self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False
+                )
+                self._connection.execute('PRAGMA journal_mode=WAL')
+                self._connection.execute('PRAGMA synchronous=NORMAL')
+                self._connection.execute(self.schema)
+                self._pid = os.getpid()
+            return self._connection.execute(sql, params).fetchall()
@@ -49,35 +49,11 @@ document.addEventListener('DOMContentLoaded', () => {
         hideError();
 
         try {
-            const response = await fetch('/analyze_mood', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ text }),
-            });
-
-            const data = await response.json();
-            if (!response.ok) {
-                throw new Error(data.error || 'Failed to analyze mood');
-            }
-
-            moodAnalysis.textContent = data.mood_analysis || 'No mood analysis available.';
-
-            const sourceInfo = data.source
-                ? `<div class="source-info">Source: ${formatSourceInfo(data.source)}</div>`
-                : '';
-
-            if (Array.isArray(data.recommendations) && data.recommendations.length > 0) {
-                const cards = data.recommendations
-                    .map((track) => buildTrackCard(track))
-                    .join('');
-                recommendationsList.innerHTML = sourceInfo + cards;
+            if (window.ReadableStream && window.TextDecoder) {
+                await analyzeStreaming(text);
             } else {
-                recommendationsList.innerHTML =
-                    sourceInfo + '<p>No recommendations found. Try describing your mood differently.</p>';
+                await analyzeAtOnce(text);
             }
-
-            resultsSection.style.display = 'block';
-            resultsSection.scrollIntoView({ behavior: 'smooth' });
         } catch (error) {
             console.error('Error:', error);
             showError(error.message || 'Failed to analyze mood.');
@@ -86,6 +62,98 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    const showResults = () => {
+        if (resultsSection.style.display !== 'block') {
+            resultsSection.style.display = 'block';
+            resultsSection.scrollIntoView({ behavior: 'smooth' });
+        }
+    };
+
+    const sourceInfoHtml = (source) =>
+        source ? `<div class="source-info">Source: ${formatSourceInfo(source)}</div>` : '';
+
+    const noRecommendationsHtml =
+        '<p>No recommendations found. Try describing your mood differently.</p>';
+
+    // Fetches everything in one response; used when the browser can't read streams
+    const analyzeAtOnce = async (text) => {
+        const response = await fetch('/analyze_mood', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ text }),
+        });
+
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Failed to analyze mood');
+        }
+
+        moodAnalysis.textContent = data.mood_analysis || 'No mood analysis available.';
+
+        const sourceInfo = sourceInfoHtml(data.source);
+
+        if (Array.isArray(data.recommendations) && data.recommendations.length > 0) {
+            const cards = data.recommendations
+                .map((track) => buildTrackCard(track))
+                .join('');
+            recommendationsList.innerHTML = sourceInfo + cards;
+        } else {
+            recommendationsList.innerHTML = sourceInfo + noRecommendationsHtml;
+        }
+
+        showResults();
+    };
+
+    // Reads newline-delimited JSON events and adds track cards as they arrive
+    const analyzeStreaming = async (text) => {
+        const response = await fetch('/analyze_mood/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ text }),
+        });
+
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(data.error || 'Failed to analyze mood');
+        }
+
+        let trackCount = 0;
+        const handleEvent = (event) => {
+            if (event.type === 'mood') {
+                moodAnalysis.textContent = event.mood_analysis || 'No mood analysis available.';
+                showResults();
+            } else if (event.type === 'tracks') {
+                const cards = event.tracks.map((track) => buildTrackCard(track)).join('');
+                recommendationsList.insertAdjacentHTML('beforeend', cards);
+                trackCount += event.tracks.length;
+            } else if (event.type === 'done') {
+                recommendationsList.insertAdjacentHTML('afterbegin', sourceInfoHtml(event.source));
+                if (trackCount === 0) {
+                    recommendationsList.insertAdjacentHTML('beforeend', noRecommendationsHtml);
+                }
+            } else if (event.type === 'error') {
+                throw new Error(event.error || 'Failed to analyze mood');
+            }
+        };
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = '';
+        for (;;) {
+            const { value, done } = await reader.read();
+            buffered += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffered.split('\n');
+            buffered = lines.pop();
+            lines.filter((line) => line.trim()).forEach((line) => handleEvent(JSON.parse(line)));
+            if (done) {
+                break;
+            }
+        }
+        if (buffered.trim()) {
+            handleEvent(JSON.parse(buffered));
+        }
+    };
+
     moodChips.forEach((chip) => {
         chip.addEventListener('click', () => {
             moodText.value = chip.textContent;
@@ -118,6 +186,9 @@ document.addEventListener('DOMContentLoaded', () => {
             return 'Unknown source';
         }
 
+        if (source.startsWith('local_catalog')) {
+            return 'Local catalog matched to your mood';
+        }
         if (source.startsWith('spotify_advanced')) {
             return 'Spotify API with advanced mood parameters';
         }
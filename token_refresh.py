@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('moosic.token_refresh')
+
+# Refresh in the background once a token is this close to expiring, so
+# requests keep using the current token instead of waiting on a refresh
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', 300))
+# Same leeway spotipy's is_token_expired() uses
+TOKEN_EXPIRY_SKEW = 60
+TOKEN_REFRESH_TIMEOUT = float(os.getenv('TOKEN_REFRESH_TIMEOUT', 10))
+
+
+class TokenRefresher:
+    """Coordinates access token refreshes across concurrent requests.
+
+    Only one refresh per refresh token runs at a time; other requests for
+    the same user wait on it and share its result. Tokens that are about to
+    expire are refreshed in the background while the current one is still
+    served. The newest token for each refresh token is remembered so a
+    request carrying an older copy (e.g. from its session cookie) picks it up.
+    """
+
+    def __init__(self, refresh, margin=TOKEN_REFRESH_MARGIN, max_tokens=10000, workers=4):
+        self._refresh = refresh
+        self.margin = margin
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._latest = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='token-refresh')
+
+    def get_token(self, token_info):
+        """Return a usable token_info for this user, refreshing only when needed"""
+        refresh_token = token_info['refresh_token']
+        with self._lock:
+            latest = self._latest.get(refresh_token)
+        if latest and latest['expires_at'] > token_info['expires_at']:
+            token_info = latest
+
+        remaining = token_info['expires_at'] - time.time()
+        if remaining < TOKEN_EXPIRY_SKEW:
+            # Expired: this request has to wait, but shares the refresh with any others
+            logger.info("Token expired, refreshing...")
+            return self._start_refresh(refresh_token).result(timeout=TOKEN_REFRESH_TIMEOUT)
+        if remaining < self.margin:
+            self._start_refresh(refresh_token)
+        return token_info
+
+    def _start_refresh(self, refresh_token):
+        with self._lock:
+            future = self._inflight.get(refresh_token)
+            if future is None:
+                future = self._pool.submit(self._run_refresh, refresh_token)
+                self._inflight[refresh_token] = future
+            return future
+
+    def _run_refresh(self, refresh_token):
+        try:
+            token_info = self._refresh(refresh_token)
+            with self._lock:
+                self._latest[refresh_token] = token_info
+                self._latest.move_to_end(refresh_token)
+                while len(self._latest) > self.max_tokens:
+                    self._latest.popitem(last=False)
+            logger.info("Token refreshed successfully")
+            return token_info
+        except Exception as e:
+            logger.error("Token refresh failed: %s", e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(refresh_token, None)
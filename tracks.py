@@ -0,0 +1,106 @@
+def has_valid_album_art(album):
+    """Check that an album has a cover image we are happy to show"""
+    if not album:
+        return False
+    images = album.get('images')
+    return bool(
+        images and
+        'url' in images[0] and
+        not images[0]['url'].endswith('dog.jpg')  # Filter out dog image
+    )
+
+
+class TrackCollector:
+    """Collects unique tracks with valid album art, in insertion order, up to a target size.
+
+    Duplicates are detected through a set of track ids (and optionally of
+    artists), so every add() costs the same no matter how many tracks have
+    been collected. Accepted tracks are stored as CompactTrack.
+    """
+
+    def __init__(self, target, unique_artists=False):
+        self.target = target
+        self.unique_artists = unique_artists
+        self.tracks = []
+        self._ids = set()
+        self._artists = set()
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    @property
+    def full(self):
+        return len(self.tracks) >= self.target
+
+    def add(self, track):
+        """Add a track if it is new and has valid album art; returns True when added"""
+        if self.full or not track:
+            return False
+        track_id = track.get('id')
+        if not track_id or track_id in self._ids:
+            return False
+        if not has_valid_album_art(track.get('album')):
+            return False
+        if self.unique_artists:
+            artist = self._artist_key(track)
+            if artist in self._artists:
+                return False
+            self._artists.add(artist)
+        self._ids.add(track_id)
+        self.tracks.append(CompactTrack.from_spotify(track))
+        return True
+
+    def extend(self, tracks):
+        """Add tracks until the collector is full; returns how many were added"""
+        added = 0
+        for track in tracks:
+            if self.full:
+                break
+            if self.add(track):
+                added += 1
+        return added
+
+    @staticmethod
+    def _artist_key(track):
+        artists = track.get('artists') or [{}]
+        return artists[0].get('id') or artists[0].get('name')
+
+
+class CompactTrack:
+    """The few fields of a Spotify track the frontend shows, projected once per track"""
+
+    __slots__ = ('id', 'name', 'artists', 'image_url', 'url')
+
+    def __init__(self, track_id, name, artists, image_url, url):
+        self.id = track_id
+        self.name = name
+        self.artists = artists
+        self.image_url = image_url
+        self.url = url
+
+    def __repr__(self):
+        return f"CompactTrack({self.id!r}, {self.name!r})"
+
+    @classmethod
+    def from_spotify(cls, track):
+        """Project a full Spotify track object (or one of our backup tracks)"""
+        album = track.get('album') or {}
+        images = album.get('images') or [{}]
+        url = (track.get('external_urls') or {}).get('spotify')
+        # Backup tracks have no id, but their Spotify URL ends with it
+        track_id = track.get('id') or (url.rsplit('/', 1)[-1] if url else None)
+        artists = tuple(artist.get('name') for artist in track.get('artists') or [])
+        return cls(track_id, track.get('name'), artists, images[0].get('url'), url)
+
+    def to_dict(self):
+        # Same shape as a Spotify track, minus everything the frontend ignores
+        return {
+            'id': self.id,
+            'name': self.name,
+            'artists': [{'name': name} for name in self.artists],
+            'album': {'images': [{'url': self.image_url}]},
+            'external_urls': {'spotify': self.url},
+        }
@@ -0,0 +1,308 @@
+import dbm
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlite_connection import SqliteConnection
+from tracks import CompactTrack
+
+logger = logging.getLogger('moosic.ttl_cache')
+
+
+def _encode(value):
+    # JSON has no set type, so tag frozensets and restore them on load
+    if isinstance(value, frozenset):
+        return {'__frozenset__': sorted(value)}
+    if isinstance(value, CompactTrack):
+        return {'__track__': [value.id, value.name, value.artists, value.image_url, value.url]}
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _decode(obj):
+    if '__frozenset__' in obj:
+        return frozenset(obj['__frozenset__'])
+    if '__track__' in obj:
+        track_id, name, artists, image_url, url = obj['__track__']
+        return CompactTrack(track_id, name, tuple(artists), image_url, url)
+    return obj
+
+
+def _dumps(entry):
+    return json.dumps(entry, default=_encode)
+
+
+def _loads(raw):
+    return json.loads(raw, object_hook=_decode)
+
+
+class MemoryBackend:
+    """Keeps entries in a dict inside this process, dropping the oldest past max_entries"""
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            if self.max_entries is not None:
+                while len(self._entries) > self.max_entries:
+                    del self._entries[next(iter(self._entries))]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class FileBackend:
+    """Keeps all entries in one JSON file so several worker processes can share them"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return _loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        # Write to a temp file and rename so readers never see a partial file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ttl_cache-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(_dumps(entries))
+            os.replace(tmp_path, self.path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key):
+        entry = self._read().get(key)
+        return tuple(entry) if entry else None
+
+    def set(self, key, entry):
+        with self._lock:
+            entries = self._read()
+            entries[key] = list(entry)
+            self._write(entries)
+
+    def delete(self, key):
+        with self._lock:
+            entries = self._read()
+            if entries.pop(key, None) is not None:
+                self._write(entries)
+
+
+class DbmBackend:
+    """Stores entries in a local dbm key-value file (stand-in for an external KV store)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                with dbm.open(self.path, 'c') as db:
+                    raw = db.get(key)
+            except dbm.error:
+                return None
+        return tuple(_loads(raw)) if raw else None
+
+    def set(self, key, entry):
+        with self._lock:
+            with dbm.open(self.path, 'c') as db:
+                db[key] = _dumps(list(entry))
+
+    def delete(self, key):
+        with self._lock:
+            with dbm.open(self.path, 'c') as db:
+                if key in db:
+                    del db[key]
+
+
+class SqliteBackend:
+    """Stores entries in a SQLite file that worker processes share and that survives restarts.
+
+    Entries past their stale_until are swept out every PURGE_INTERVAL seconds.
+    """
+
+    PURGE_INTERVAL = 3600
+
+    def __init__(self, path):
+        self.path = path
+        self._db = SqliteConnection(
+            path, 'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, entry TEXT NOT NULL, stale_until REAL NOT NULL)'
+        )
+        self._purged_at = 0.0
+
+    def _execute(self, sql, params=()):
+        return self._db.execute(sql, params)
+
+    def get(self, key):
+        try:
+            rows = self._execute('SELECT entry FROM entries WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logger.warning("Failed to read cache entry '%s': %s", key, e)
+            return None
+        return tuple(_loads(rows[0][0])) if rows else None
+
+    def set(self, key, entry):
+        now = time.time()
+        self._execute(
+            'INSERT OR REPLACE INTO entries (key, entry, stale_until) VALUES (?, ?, ?)',
+            (key, _dumps(list(entry)), entry[2])
+        )
+        if now - self._purged_at > self.PURGE_INTERVAL:
+            self._purged_at = now
+            self._execute('DELETE FROM entries WHERE stale_until < ?', (now,))
+
+    def delete(self, key):
+        self._execute('DELETE FROM entries WHERE key = ?', (key,))
+
+
+BACKENDS = {
+    'memory': lambda path: MemoryBackend(),
+    'file': FileBackend,
+    'dbm': DbmBackend,
+    'sqlite': SqliteBackend,
+}
+
+
+def make_backend(kind='memory', path=None):
+    """Build a cache backend by name: 'memory', 'file', 'dbm' or 'sqlite'"""
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown cache backend '{kind}', expected one of {sorted(BACKENDS)}")
+    if kind != 'memory' and not path:
+        raise ValueError(f"Cache backend '{kind}' needs a path")
+    return BACKENDS[kind](path)
+
+
+class TTLCache:
+    """Process-wide cache with a TTL and stale-while-revalidate refresh.
+
+    Entries are (value, fresh_until, stale_until). A fresh entry is returned
+    as is. A stale entry is still returned, but a background thread reloads
+    it. Past stale_until the value is loaded inline, once per key however
+    many callers are waiting for it. Entries always live in a local memory
+    tier; with a file, dbm or sqlite backend that tier sits in front of it,
+    and the backend is only consulted when the local copy is no longer
+    fresh.
+    """
+
+    def __init__(self, backend=None, ttl=3600, stale_ttl=86400, max_entries=None):
+        if isinstance(backend, MemoryBackend):
+            self._local = backend
+            self.backend = None
+        else:
+            self._local = MemoryBackend(max_entries)
+            self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._loading = {}  # key -> Future of the inline load in progress
+
+    def _lookup(self, key, now):
+        entry = self._local.get(key)
+        if self.backend is not None and (entry is None or now >= entry[1]):
+            # Another process may have refreshed it in the shared backend
+            shared = self.backend.get(key)
+            if shared is not None and (entry is None or shared[1] > entry[1]):
+                entry = shared
+                self._local.set(key, entry)
+        return entry
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader() when needed"""
+        now = time.time()
+        entry = self._lookup(key, now)
+        if entry is not None:
+            value, fresh_until, stale_until = entry
+            if now < fresh_until:
+                return value
+            if now < stale_until:
+                self.refresh_in_background(key, loader)
+                return value
+        return self._load_once(key, loader)
+
+    def peek(self, key):
+        """Return (value, is_fresh) without loading anything, or None when there is nothing to serve"""
+        now = time.time()
+        entry = self._lookup(key, now)
+        if entry is None or now >= entry[2]:
+            return None
+        return entry[0], now < entry[1]
+
+    def set(self, key, value, ttl=None, stale_ttl=None):
+        now = time.time()
+        fresh_until = now + (self.ttl if ttl is None else ttl)
+        stale_until = fresh_until + (self.stale_ttl if stale_ttl is None else stale_ttl)
+        entry = (value, fresh_until, stale_until)
+        self._local.set(key, entry)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, entry)
+            except Exception as e:
+                logger.warning("Failed to persist cache entry '%s': %s", key, e)
+        return value
+
+    def invalidate(self, key):
+        self._local.delete(key)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def _load(self, key, loader):
+        return self.set(key, loader())
+
+    def _load_once(self, key, loader):
+        """Load key inline; concurrent callers for the same key wait for one load and share its outcome"""
+        with self._lock:
+            future = self._loading.get(key)
+            loading = future is None
+            if loading:
+                future = self._loading[key] = Future()
+        if not loading:
+            return future.result()
+        try:
+            future.set_result(self._load(key, loader))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._loading[key]
+        return future.result()
+
+    def refresh_in_background(self, key, loader):
+        """Reload key with loader() on a background thread, unless that is already happening"""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._load(key, loader)
+            except Exception as e:
+                # Keep serving the stale value until the next attempt
+                logger.warning("Background refresh of '%s' failed: %s", key, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name=f'ttl-cache-refresh-{key}', daemon=True).start()